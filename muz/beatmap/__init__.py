@@ -10,9 +10,11 @@ log = logging.getLogger(__name__)
 import muz.vfs
 import muz.util
 
-from .note import Note
+from .note import Note, NoteArray
 from .meta import Metadata
 from . import formats, transform
 from .beatmap import Beatmap
 from .builder import Builder as BeatmapBuilder
-from .misc import load, nameFromPath, export, main
+from .cache import beatmapCache
+from .misc import load, nameFromPath, listNames, listPaths, export, main
+from .library import beatmapLibrary
@@ -5,17 +5,22 @@ from __future__ import division
 from __future__ import unicode_literals
 
 import collections, os
+from bisect import bisect_left
+from array import array
 from functools import partial
+from itertools import izip
 
 import muz
 import muz.assets
 import muz.vfs as vfs
 
-from . import log, formats, transform, Metadata, Note
+from . import log, formats, transform, Metadata, Note, NoteArray
 
 class Beatmap(collections.MutableSequence):
     def __init__(self, name, numbands, music=None, musicFile=None, source=None, meta=None, vfsNode=None):
-        self.notelist = []
+        self.notelist = NoteArray()
+        self._bandIndex = None
+        self._indexedLayout = None
         self._meta = Metadata()
         self.name = name
         self.music = music
@@ -36,9 +41,14 @@ class Beatmap(collections.MutableSequence):
             self.meta.update(meta)
 
     def clone(self):
-        notes = (note.clone() for note in self)
-        bmap = Beatmap(self.name, self.numbands, source=notes, meta=self.meta, vfsNode=self.vfsNode, musicFile=self._musicFile)
+        # the notes are copy-on-write, a clone that isn't changed much costs next to nothing
+        bmap = Beatmap(self.name, self.numbands, music=self.music, meta=self.meta, vfsNode=self.vfsNode, musicFile=self._musicFile)
+        bmap.notelist = self.notelist.copy()
         bmap.noterate = self.noterate
+
+        # it's never changed in place, only rebuilt
+        bmap._bandIndex = self._bandIndex
+        bmap._indexedLayout = self._indexedLayout
         return bmap
 
     @property
@@ -75,18 +85,62 @@ class Beatmap(collections.MutableSequence):
         self._meta.clear()
         self._meta.update(v)
 
-    def nearest(self, band, time, maxdiff):
+    def invalidateIndex(self):
+        # must be called after changing bands, times or hint flags of the notes other than through the
+        # methods of Beatmap (transforms called as methods are fine). Removing notes doesn't invalidate it.
+        self._bandIndex = None
+
+    def buildIndex(self):
+        # for every band: the hit times of its notes (hints excluded) in order, their rows and the longest hold.
+        # Rows rather than views, views would have to be made for every note.
+        notes = self.notelist
+
+        bands, hitTimes, holdTimes, isHint = notes.band, notes.hitTime, notes.holdTime, notes.isHint
+        rows = collections.defaultdict(list)
+
+        for row in sorted(notes.rows, key=hitTimes.__getitem__):
+            if not isHint[row]:
+                rows[bands[row]].append(row)
+
+        self._bandIndex = dict((band, (
+            array(b'i', [hitTimes[row] for row in r]),
+            array(b'i', r),
+            max(holdTimes[row] for row in r),
+        )) for band, r in rows.items())
+
+        # valid until the rows move
+        self._indexedLayout = notes.compactions
+
+    def nearest(self, band, time, maxdiff, skip=()):
+        # skip is a container of notes to ignore, e.g. the ones already judged
+        notes = self.notelist
+
+        if self._bandIndex is None or self._indexedLayout != notes.compactions:
+            self.buildIndex()
+
+        try:
+            times, rows, maxHold = self._bandIndex[band]
+        except KeyError:
+            return None
+
         o = None
         od = maxdiff
 
-        for n in self:
-            if n.band == band and not n.isHint:
-                d = n.hitTime - time
+        # anything that starts earlier ends too early to be in range, even with the longest hold in the band
+        first = bisect_left(times, time - maxdiff - maxHold)
+        last = bisect_left(times, time + maxdiff)
+
+        for i in xrange(first, last):
+            row = rows[i]
+
+            if not notes.isAlive(row):
+                continue
 
-                if d >= maxdiff:
-                    break
+            n = notes.view(row)
 
-                d = min(abs(d), abs(d + n.holdTime))
+            if n not in skip:
+                d = times[i] - time
+                d = min(abs(d), abs(d + notes.holdTime[row]))
 
                 if d < od:
                     o = n
@@ -100,6 +154,15 @@ class Beatmap(collections.MutableSequence):
     def __len__(self):
         return len(self.notelist)
 
+    def __iter__(self):
+        return iter(self.notelist)
+
+    def __contains__(self, note):
+        return note in self.notelist
+
+    def index(self, note, *args):
+        return self.notelist.index(note, *args)
+
     def __getitem__(self, i):
         return self.notelist[i]
 
@@ -109,11 +172,12 @@ class Beatmap(collections.MutableSequence):
     def __setitem__(self, i, v):
         self.checknote(v)
         self.notelist[i] = v
-        v.num = i
+        self._bandIndex = None
 
     def insert(self, i, v):
         self.checknote(v)
         self.notelist.insert(i, v)
+        self._bandIndex = None
 
     def __str__(self):
         return repr(self)
@@ -153,41 +217,46 @@ class Beatmap(collections.MutableSequence):
     @property
     def minimalNoteDistance(self):
         mindist = 0
+        notes = self.notelist
+        notes.compact()
 
         prev = None
-        for note in self:
-            if not note.isHint:
+        for hitTime, isHint in izip(notes.hitTime, notes.isHint):
+            if not isHint:
                 if prev is not None:
-                    d = note.hitTime - prev.hitTime
+                    d = hitTime - prev
                     if not mindist or (d > 20 and d < mindist):
                         mindist = d
-                prev = note
+                prev = hitTime
 
         return mindist
 
     def storeRefs(self):
-        for i, note in enumerate(self):
-            note.num = i
+        notes = self.notelist
+
+        for note in notes:
             if note.ref < 0:
                 note.refObj = None
             else:
-                note.refObj = self[note.ref]
+                note.refObj = notes[note.ref]
 
     def updateRefs(self):
-        for i, note in enumerate(self):
-            note.num = i
+        for note in self.notelist:
             if note.refObj is None:
                 note.ref = -1
             else:
                 note.ref = note.refObj.num
 
     def sort(self):
-        self.notelist.sort(key=lambda note: note.hitTime)
+        self.notelist.sort()
+        self._bandIndex = None
 
     def fix(self):
-        self.storeRefs()
-        self.sort()
-        self.updateRefs()
+        # same as storeRefs, sort, updateRefs, without going through the views
+        self.notelist.sort(keepRefs=True)
+        self._bandIndex = None
 
     def __getattr__(self, attr):
+        # a transform is about to change the notes
+        self._bandIndex = None
         return partial(getattr(transform, attr), self)
@@ -0,0 +1,155 @@
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+from __future__ import unicode_literals
+
+import os, logging, hashlib, json
+import cPickle as pickle
+log = logging.getLogger(__name__)
+
+import muz
+import muz.config
+import muz.util
+
+from .beatmap import Beatmap
+from .formats import muzb
+
+config = muz.config.get(__name__, {
+    "enabled"   : True,
+    "max-size"  : 64,
+})
+
+# bump this whenever the layout of the stored entries changes
+VERSION = 1
+
+class BeatmapCache(object):
+    # Keeps the results of importer.read around in the userdir, so that unchanged beatmaps don't have to be parsed again.
+    # Entries are keyed by everything that could affect the result: the importer, the vfs path, a fingerprint of
+    # the source file (size and mtime, or the CRC for pack members), the read arguments and the importer's config.
+
+    def __init__(self):
+        self.path = None
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+
+    def open(self, path):
+        self.path = path
+
+    @property
+    def enabled(self):
+        return self.path is not None and config["enabled"] and config["max-size"] > 0
+
+    def key(self, importer, node, vpath, bare, options):
+        if not getattr(importer, "cacheable", True):
+            return None
+
+        fingerprint = node.fingerprint
+        if fingerprint is None:
+            return None
+
+        # some importers apply their settings while reading (e.g. the tianyi9 offset)
+        importerConfig = json.dumps(getattr(importer, "config", None), sort_keys=True)
+
+        h = hashlib.sha1()
+        h.update(repr((VERSION, importer.__name__, vpath, fingerprint, bool(bare), options, importerConfig)))
+        return h.hexdigest()
+
+    def read(self, importer, node, vpath, bare=False, options=None):
+        key = None
+
+        if self.enabled:
+            try:
+                key = self.key(importer, node, vpath, bare, options)
+            except Exception:
+                log.warning("couldn't fingerprint %s, not caching it", repr(vpath))
+                log.debug("dumping traceback", exc_info=True)
+
+        if key is None:
+            return importer.read(node.open(), node.name, bare=bare, options=options)
+
+        fpath = os.path.join(self.path, key)
+
+        if os.path.exists(fpath):
+            try:
+                bmap = self.load(fpath)
+            except Exception:
+                log.warning("couldn't load the cached copy of %s, parsing it again", repr(vpath))
+                log.debug("dumping traceback", exc_info=True)
+            else:
+                log.info("loaded %s from the beatmap cache", repr(vpath))
+                self.hits += 1
+
+                # the mtime doubles as the last access time for eviction
+                os.utime(fpath, None)
+                return bmap
+
+        self.misses += 1
+        bmap = importer.read(node.open(), node.name, bare=bare, options=options)
+
+        try:
+            self.store(fpath, bmap)
+        except Exception:
+            log.warning("couldn't store %s in the beatmap cache", repr(vpath))
+            log.debug("dumping traceback", exc_info=True)
+
+        return bmap
+
+    def load(self, fpath):
+        with open(fpath, 'rb') as f:
+            version, name, numbands, music, noterate, meta, records, side = pickle.load(f)
+
+        if version != VERSION:
+            raise ValueError("cache entry version mismatch")
+
+        bmap = Beatmap(name, numbands, music, meta=meta)
+        bmap.noterate = noterate
+        muzb.unpackNotes(bmap, records, side)
+
+        return bmap
+
+    def store(self, fpath, bmap):
+        records, side = muzb.packNotes(bmap)
+        entry = (VERSION, bmap.name, bmap.numbands, bmap.music, bmap.noterate, dict(bmap.meta), records, side)
+
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+        tmp = "%s.%i.tmp" % (fpath, os.getpid())
+
+        with open(tmp, 'wb') as f:
+            pickle.dump(entry, f, pickle.HIGHEST_PROTOCOL)
+
+        try:
+            os.rename(tmp, fpath)
+        except OSError:
+            # another instance got there first (windows won't rename over an existing file)
+            os.remove(tmp)
+
+        self.stores += 1
+        self.evict(keep=(fpath,))
+
+    def evict(self, keep=()):
+        muz.util.evictLRU(self.path, config["max-size"] * 1024 * 1024, keep=keep)
+
+    def stats(self):
+        entries = 0
+        size = 0
+
+        if self.path is not None and os.path.isdir(self.path):
+            for f in os.listdir(self.path):
+                entries += 1
+                size += os.path.getsize(os.path.join(self.path, f))
+
+        return {
+            "path"      : self.path,
+            "enabled"   : self.enabled,
+            "entries"   : entries,
+            "size"      : size,
+            "max-size"  : config["max-size"] * 1024 * 1024,
+            "hits"      : self.hits,
+            "misses"    : self.misses,
+            "stores"    : self.stores,
+        }
+
+beatmapCache = BeatmapCache()
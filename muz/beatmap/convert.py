@@ -0,0 +1,339 @@
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+from __future__ import unicode_literals
+
+import os, sys, logging, hashlib, multiprocessing
+from io import BytesIO
+
+log = logging.getLogger(__name__)
+
+import muz
+import muz.main
+import muz.util
+import muz.vfs as vfs
+import muz.beatmap
+
+# set up by initWorker in every process that converts beatmaps
+settings = None
+
+def findSources(sources):
+    # Expands real directories (recursively), real files and vfs globs into beatmap names loadable with
+    # muz.beatmap.load. Real paths are made absolute, vfs paths are turned into beatmap names where possible.
+    exts = muz.beatmap.formats.importersByInferExt
+    names = []
+
+    for src in sources:
+        if os.path.isdir(src):
+            for dirpath, dirnames, filenames in os.walk(src):
+                dirnames.sort()
+                for f in sorted(filenames):
+                    if f.rpartition('.')[2] in exts:
+                        names.append(os.path.abspath(os.path.join(dirpath, f)))
+        elif os.path.isfile(src):
+            names.append(os.path.abspath(src))
+        else:
+            found = False
+
+            for path, obj, _ in vfs.root.walk(pattern=vfs.normalizePath(src), exts=exts):
+                names.append(muz.beatmap.nameFromPath(path + obj) or vfs.VPATH_SEP + path + obj)
+                found = True
+
+            if not found:
+                log.warning("%s didn't match any beatmaps", repr(src))
+
+    # keep the first occurence of every name
+    seen = set()
+    return [n for n in names if not (n in seen or seen.add(n))]
+
+def initWorker(argv, conf):
+    global settings
+    settings = conf
+
+    if muz.main.globalArgs is None:
+        # a fresh interpreter (no fork), set everything up from scratch
+        muz.main.handleGeneralArgs(muz.main.initArgParser(), list(argv), None)
+        muz.main.init()
+    else:
+        # the configuration came with the fork, but the vfs (open archives, mappings) must not be shared
+        muz.main.initvfs()
+
+def musicSource(node):
+    # something the parent process can open the music with: a vfs path, a real path or, failing that, the data
+    path = vfs.root.trace(node)
+
+    if path is not None:
+        return "vfs", path
+
+    if node.realPathExists:
+        return "real", node.realPath
+
+    f = node.open()
+    try:
+        return "data", f.read()
+    finally:
+        f.close()
+
+def openMusic(source):
+    kind, val = source
+
+    if kind == "vfs":
+        return vfs.locate(val).open()
+
+    if kind == "real":
+        return open(val, 'rb')
+
+    return BytesIO(val)
+
+def convertOne(name, music=None):
+    # music overrides the name the music is stored under, see Output.add
+    try:
+        format = muz.beatmap.formats.exportersByName[settings["format"]]
+        bmap = muz.beatmap.load(name, options=settings["importer-options"])
+
+        node = bmap.musicVfsNode
+        source = musicSource(node)
+        fingerprint = node.fingerprint
+
+        if fingerprint is not None:
+            key = repr(fingerprint)
+        elif source[0] == "data":
+            key = hashlib.sha1(source[1]).hexdigest()
+        else:
+            key = repr(source)
+
+        ext = os.path.splitext(bmap.music)[-1]
+
+        if music is None:
+            # named explicitly, so that every format stores music shared by several beatmaps under the same name
+            music = os.path.basename(bmap.music)
+
+        s = BytesIO()
+        newname, mappath, muspath = format.write(bmap, s, options=settings["exporter-options"], music=music)
+
+        return {
+            "source"    : name,
+            "name"      : newname,
+            "mappath"   : mappath,
+            "mapdata"   : s.getvalue(),
+            "muspath"   : muspath + ext,
+            "musname"   : music,
+            "muskey"    : key,
+            "music"     : source,
+        }
+    except Exception as e:
+        log.debug("dumping traceback", exc_info=True)
+        return {
+            "source"    : name,
+            "error"     : "%s: %s" % (type(e).__name__, e),
+        }
+
+class Output(object):
+    # Writes converted beatmaps into packs, storing every music file only once per pack.
+
+    def __init__(self, packType, name=None, split=False):
+        self.packType = packType
+        self.name = name
+        self.split = split
+        self.packs = {}
+        self.packNames = set()
+        self.errors = []
+        self.converted = 0
+        self.musicStored = 0
+        self.musicShared = 0
+
+    def packFor(self, result):
+        key = result["muskey"] if self.split else None
+        entry = self.packs.get(key)
+
+        if entry is None:
+            if self.split:
+                name = "beatmap-%s" % result["name"]
+            else:
+                name = self.name or "converted-beatmaps"
+
+            base, i = name, 1
+            while name in self.packNames:
+                i += 1
+                name = "%s-%i" % (base, i)
+
+            self.packNames.add(name)
+            entry = self.packs[key] = (self.packType(name, ifExists='remove'), {}, set())
+
+        return entry
+
+    def add(self, result):
+        if "error" in result:
+            self.fail(result["source"], result["error"])
+            return
+
+        pack, music, maps = self.packFor(result)
+        mappath, muspath, muskey = result["mappath"], result["muspath"], result["muskey"]
+
+        if mappath in maps:
+            self.fail(result["source"], "%s is already in %s" % (mappath, pack.path))
+            return
+
+        stored = music.get(muspath)
+
+        if stored is not None and stored != muskey:
+            # a different song that happens to have the same name, convert this one again with a distinct one
+            stem, ext = os.path.splitext(result["musname"])
+            renamed = convertOne(result["source"], "%s.%s%s" % (stem, hashlib.sha1(muskey.encode('utf-8')).hexdigest()[:8], ext))
+
+            if "error" in renamed:
+                self.fail(renamed["source"], renamed["error"])
+                return
+
+            if renamed["mappath"] in maps:
+                self.fail(result["source"], "%s is already in %s" % (renamed["mappath"], pack.path))
+                return
+
+            result = renamed
+            mappath, muspath = result["mappath"], result["muspath"]
+            stored = music.get(muspath)
+
+        if stored is None:
+            try:
+                with openMusic(result["music"]) as mus:
+                    pack.addFile(muspath, mus)
+            except Exception as e:
+                log.debug("dumping traceback", exc_info=True)
+                self.fail(result["source"], "couldn't store the music: %s" % e)
+                return
+
+            music[muspath] = muskey
+            self.musicStored += 1
+        elif stored == muskey:
+            self.musicShared += 1
+        else:
+            self.fail(result["source"], "%s in %s belongs to another song" % (muspath, pack.path))
+            return
+
+        pack.addFile(mappath, BytesIO(result["mapdata"]))
+        maps.add(mappath)
+        self.converted += 1
+
+        log.info("converted %s as %s", result["source"], mappath)
+
+    def fail(self, source, error):
+        log.error("failed to convert %s: %s", source, error)
+        self.errors.append((source, error))
+
+    def close(self):
+        for pack, music, maps in self.packs.values():
+            pack.save()
+            log.info("wrote %s (%i beatmaps, %i music files)", pack.path, len(maps), len(music))
+
+def convert(names, format, jobs=None, packType=vfs.Pack, name=None, split=False, importerOptions=None, exporterOptions=None, argv=()):
+    global settings
+
+    conf = {
+        "format"            : format,
+        "importer-options"  : importerOptions,
+        "exporter-options"  : exporterOptions,
+    }
+
+    if jobs is None:
+        jobs = multiprocessing.cpu_count()
+
+    # the parent needs it too, to redo beatmaps whose music names clash
+    settings = conf
+    out = Output(packType, name=name, split=split)
+
+    if jobs > 1 and len(names) > 1:
+        pool = multiprocessing.Pool(min(jobs, len(names)), initializer=initWorker, initargs=(argv, conf))
+
+        try:
+            for result in pool.imap(convertOne, names):
+                out.add(result)
+        except:
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()
+    else:
+        for n in names:
+            out.add(convertOne(n))
+
+    out.close()
+    return out
+
+def handleArgs(parser, argv, namespace):
+    g = parser.add_argument_group(title="conversion options")
+
+    g.add_argument('sources', metavar='SOURCE', type=str, nargs='+',
+                   help='a real directory (searched recursively), a real beatmap file or a vfs glob (e.g. "beatmaps/*.osu")')
+
+    g.add_argument('--format', action="store", default="muz", choices=list(muz.beatmap.formats.exportersByName.keys()),
+                   help="the beatmap format to convert to (default: %(default)s)")
+
+    g.add_argument('-j', '--jobs', metavar='N', type=int, default=None,
+                   help="the number of worker processes (default: the number of CPUs)")
+
+    g.add_argument('--split', action='store_true', default=False,
+                   help='write one pack per song instead of a single pack with all the beatmaps')
+
+    g.add_argument('--virtual', action='store_true', default=False,
+                   help='write virtual packs (.pk3dir) instead of zipped ones (.pk3)')
+
+    g.add_argument('--pack-name', dest='packname', metavar='NAME', action='store', default=None,
+                   help='the name of the pack if not --split (default: converted-beatmaps)')
+
+    g.add_argument('--importer-options', action='store', default=None,
+                   help='pass an option string to the beatmap importer')
+
+    g.add_argument('--exporter-options', action='store', default=None,
+                   help='pass an option string to the beatmap exporter')
+
+    if namespace.help:
+        return namespace, argv
+
+    return parser.parse_known_args(argv, namespace=namespace)
+
+@muz.util.entrypoint
+def main(*argv):
+    global log
+    log = logging.getLogger("muz.beatmap.convert")
+
+    argv = list(argv[1:])
+    generalArgv = list(argv)
+
+    p = muz.main.initArgParser(desc="%s: convert beatmaps in bulk" % muz.main.NAME)
+    n = None
+
+    n, argv = muz.main.handleGeneralArgs(p, argv, n)
+    n, argv = handleArgs(p, argv, n)
+    n, argv = muz.main.handleRemainingArgs(p, argv, n)
+
+    muz.main.init(requireLogLevel=logging.INFO)
+
+    names = findSources(n.sources)
+    if not names:
+        log.error("no beatmaps to convert")
+        exit(1)
+
+    out = convert(names, n.format,
+        jobs=n.jobs,
+        packType=vfs.VirtualPack if n.virtual else vfs.Pack,
+        name=n.packname,
+        split=n.split,
+        importerOptions=n.importer_options,
+        exporterOptions=n.exporter_options,
+        argv=generalArgv,
+    )
+
+    print("converted %i of %i beatmaps into %i pack(s), %i music file(s) stored, %i shared" % (
+        out.converted, len(names), len(out.packs), out.musicStored, out.musicShared
+    ))
+
+    for source, error in out.errors:
+        print("failed: %s: %s" % (source, error))
+
+    if out.errors:
+        exit(1)
+
+if __name__ == "__main__":
+    main(*sys.argv)
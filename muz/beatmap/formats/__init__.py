@@ -6,6 +6,12 @@ from __future__ import unicode_literals
 
 import importlib
 
+# how much of a file metadata probes read at a time; most headers fit into the first chunk
+probeChunkSize = 4096
+
+# in registration order, which is also the order of preference when resolving beatmaps
+importers = []
+
 importersByExt = {}
 importersByInferExt = {}
 importersByName = {}
@@ -16,6 +22,7 @@ exportersByName = {}
 
 def register(module, name):
     if hasattr(module, "read"):
+        importers.append(module)
         importersByExt.update({e: module for e in module.extensions})
         importersByInferExt.update({e: module for e in module.inferExtensions})
 
@@ -24,6 +31,6 @@ def register(module, name):
         exportersByInferExt.update({e: module for e in module.inferExtensions})
         exportersByName[name] = module
 
-for name in "muz", "pack", "osu", "siftrain", "tianyi9":
+for name in "muz", "muzb", "pack", "osu", "siftrain", "tianyi9":
     module = importlib.import_module("muz.beatmap.formats." + name)
     register(module, name)
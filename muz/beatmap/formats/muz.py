@@ -5,11 +5,13 @@ from __future__ import print_function
 from __future__ import division
 from __future__ import unicode_literals
 
-import logging, shutil, os
+import logging, shutil, os, codecs
+from itertools import izip
 log = logging.getLogger(__name__)
 
 import muz
 import muz.vfs
+import muz.util
 import muz.beatmap
 
 name = "μz beatmap"
@@ -22,114 +24,190 @@ VERSION = "1"
 class ParseError(Exception):
     pass
 
-def read(fobj, filename, bare=False, options=None):
-    buf = b""
-    bmap = muz.beatmap.Beatmap(None, 1)
-    initialized = False
-    essentialParsed = False
-    maxnotes = 0
-    lastnote = None
+class Reader(object):
+    def __init__(self, bare):
+        self.bmap = muz.beatmap.Beatmap(None, 1)
+        self.bare = bare
+        self.initialized = False
+        self.essentialParsed = False
+        self.parseNotes = False
+        self.maxnotes = 0
+        self.lastnote = None
+
+        self.handlers = {
+            "version"   : self.version,
+            "meta"      : self.meta,
+            "essential" : self.essential,
+            "rate"      : self.rate,
+            "var"       : self.var,
+            "ref"       : self.ref,
+            "refvar"    : self.refvar,
+        }
+
+    def statement(self, s, args):
+        if s == "version":
+            return self.version(args)
+
+        if not self.initialized:
+            raise ParseError("statement %s encountered before 'version'" % s)
+
+        handler = self.handlers.get(s)
+
+        if handler is None:
+            log.warning("unknown statement %s ignored", repr(s))
+        else:
+            handler(args)
+
+    def version(self, args):
+        if self.initialized:
+            log.warning("duplicate 'version' statement ignored")
+        else:
+            self.initialized = True
+            if args != VERSION:
+                log.warning("unsupported version %s", repr(args))
+
+    def meta(self, args):
+        key, val = args.split(' ', 1)
+        self.bmap.meta[key] = val
+
+    def essential(self, args):
+        if self.essentialParsed:
+            log.warning("duplicate 'essential' statement ignored")
+            return
+
+        args = args.split(' ', 2)
+
+        self.maxnotes = int(args[0])
+        self.bmap.numbands = int(args[1])
+        self.bmap.music = args[2]
+
+        self.essentialParsed = True
+        self.parseNotes = not self.bare
+
+    def rate(self, args):
+        self.bmap.noterate = float(args)
+
+    # notes aren't parsed in bare mode, so there is nothing to attach these to
+
+    def var(self, args):
+        if self.parseNotes:
+            self.lastnote.varBands = [int(a) for a in args.split(' ')]
+
+    def ref(self, args):
+        if self.parseNotes:
+            args = args.split(' ')
+            self.lastnote.ref = int(args[0])
+            self.lastnote.refOfs = int(args[1])
+
+    def refvar(self, args):
+        if self.parseNotes:
+            self.lastnote.refVarOfs = [int(a) for a in args.split(' ')]
+
+def sniff(head):
+    # the first thing that isn't a comment has to be the version line
+    for line in head.lstrip(codecs.BOM_UTF8).splitlines():
+        line = line.strip()
+
+        if line and not line.startswith(b"#"):
+            return line.startswith(b"version")
+
+    return False
+
+def probe(fobj, filename, options=None):
+    # everything but the notes, assuming the header comes first (as written by write)
+    r = Reader(True)
+
+    for line in muz.util.iterLines(fobj, 'utf-8', chunkSize=muz.beatmap.formats.probeChunkSize):
+        if line[0] == '#':
+            continue
 
-    while True:
-        byte = fobj.read(1)
+        s, args = line.split(' ', 1)
 
-        if not byte:
+        if s == "note" or s == "hint":
+            if not r.initialized:
+                raise ParseError("statement %s encountered before 'version'" % s)
             break
 
-        if byte in (b'\r', b'\n'):
-            if buf:
-                buf = buf.decode('utf-8')
-
-                if buf[0] != '#':
-                    s, args = buf.split(' ', 1)
-
-                    if s == "version":
-                        if initialized:
-                            log.warning("duplicate 'version' statement ignored")
-                        else:
-                            initialized = True
-                            if args != VERSION:
-                                log.warning("unsupported version %s", repr(args))
-                    elif not initialized:
-                        raise ParseError("statement %s encountered before 'version'" % s)
-                    elif s == "meta":
-                        key, val = args.split(' ', 1)
-                        bmap.meta[key] = val
-                    elif s == "essential":
-                        if essentialParsed:
-                            log.warning("duplicate 'essential' statement ignored")
-                        elif not bare:
-                            args = args.split(' ', 2)
-
-                            maxnotes = int(args[0])
-                            bmap.numbands = int(args[1])
-                            bmap.music = args[2]
-
-                        essentialParsed = True
-                    elif s == "rate":
-                        bmap.noterate = float(args)
-                    elif s == "note" or s == "hint":
-                        if not bare and essentialParsed:
-                            args = args.split(' ')
-                            lastnote = muz.beatmap.Note(
-                                *(int(a) for a in args[:2] + [args[2] if len(args) > 2 else 0]),
-                                isHint=(s == "hint")
-                            )
-                            bmap.append(lastnote)
-                    elif s == "var":
-                        args = [int(a) for a in args.split(' ')]
-                        lastnote.varBands = args
-                    elif s == "ref":
-                        args = args.split(' ')
-                        lastnote.ref = int(args[0])
-                        lastnote.refOfs = int(args[1])
-                    elif s == "refvar":
-                        args = [int(a) for a in args.split(' ')]
-                        lastnote.refVarOfs = args
-                    else:
-                        log.warning("unknown statement %s ignored", repr(s))
-            buf = b""
+        r.statement(s, args)
+
+    r.bmap.applyMeta()
+    return r.bmap
+
+def read(fobj, filename, bare=False, options=None):
+    if bare:
+        return probe(fobj, filename, options=options)
+
+    r = Reader(bare)
+    bmap = r.bmap
+    notes = bmap.notelist
+    Note = muz.beatmap.Note
+
+    for line in muz.util.iterLines(fobj, 'utf-8'):
+        if line[0] == '#':
             continue
 
-        buf += byte
-    
-    if not bare:
-        if len(bmap) < maxnotes:
-            log.warning("premature EOF: expected %i notes, got %i", maxnotes, len(bmap))
+        s, args = line.split(' ', 1)
 
-        if not essentialParsed or not maxnotes > 0:
-            raise ParseError("empty beatmap")
+        # the vast majority of statements, so they get a fast path
+        if s == "note" or s == "hint":
+            if r.parseNotes:
+                args = args.split(' ')
+                r.lastnote = Note(int(args[0]), int(args[1]), int(args[2]) if len(args) > 2 else 0, isHint=(s == "hint"))
+                notes.append(r.lastnote)
+            elif not r.initialized:
+                raise ParseError("statement %s encountered before 'version'" % s)
+        else:
+            r.statement(s, args)
+
+    if len(bmap) < r.maxnotes:
+        log.warning("premature EOF: expected %i notes, got %i", r.maxnotes, len(bmap))
+
+    if not r.essentialParsed or not r.maxnotes > 0:
+        raise ParseError("empty beatmap")
 
     bmap.applyMeta()
     return bmap
 
-def write(bmap, fobj, options=None):
+def write(bmap, fobj, options=None, music=None):
+    # music is the name to store the music under instead of bmap.music, see muz.beatmap.export
     bmap.fix()
-    mus = bmap.music.encode('utf-8')
+    mus = (bmap.music if music is None else music).encode('utf-8')
 
-    out = lambda s: fobj.write(s.encode('utf-8'))
-    lst = lambda s: reduce(lambda x, y: x + y, (" %i" % i for i in s), "")
-
-    out("# generated by %s-%s\nversion 1\nessential %i %i %s\nrate %f\n" %
-       (muz.NAME, muz.VERSION, len(bmap), bmap.numbands, mus, bmap.noterate)
-    )
+    # everything goes into one list of byte chunks, written in one go at the end;
+    # only the header and metadata can be non-ascii, the notes are rendered as bytes directly
+    head = ["# generated by %s-%s\nversion 1\nessential %i %i %s\nrate %f\n" %
+        (muz.NAME, muz.VERSION, len(bmap), bmap.numbands, mus, bmap.noterate)
+    ]
 
     for key, val in sorted(bmap.meta.items(), key=lambda p: p[0]):
-        out("meta %s %s\n" % (key, val))
+        head.append("meta %s %s\n" % (key, val))
+
+    buf = ["".join(head).encode('utf-8')]
+    out = buf.append
+    lst = lambda s: b"".join([b" %i" % i for i in s])
+
+    # fix() leaves the notes compacted, so the columns are in order
+    notes = bmap.notelist
+
+    for band, hitTime, holdTime, isHint, ref, refOfs, varBands, refVarOfs in izip(
+            notes.band, notes.hitTime, notes.holdTime, notes.isHint,
+            notes.ref, notes.refOfs, notes.varBands, notes.refVarOfs):
+        kind = b"hint" if isHint else b"note"
+
+        if holdTime:
+            out(b"%s %i %i %s\n" % (kind, band, hitTime, holdTime))
+        else:
+            out(b"%s %i %i\n" % (kind, band, hitTime))
 
-    for note in bmap:
-        out("%s %i %i%s\n" % (
-            "hint" if note.isHint else "note", note.band, note.hitTime,
-            (" " + str(note.holdTime)) if note.holdTime else ""
-        ))
+        if varBands is not None:
+            out(b"var%s\n" % lst(varBands))
 
-        if note.varBands is not None:
-            out("var%s\n" % lst(note.varBands))
+        if ref >= 0:
+            out(b"ref %i %i\n" % (ref, refOfs))
 
-        if note.ref >= 0:
-            out("ref %i %i\n" % (note.ref, note.refOfs))
+        if refVarOfs is not None:
+            out(b"refvar%s\n" % lst(refVarOfs))
 
-        if note.refVarOfs is not None:
-            out("refvar%s\n" % lst(note.refVarOfs))
+    fobj.write(b"".join(buf))
 
     return bmap.name, "%s/%s.%s" % (locations[0], bmap.name, extensions[0]), "%s/%s" % (locations[0], os.path.splitext(mus)[0])
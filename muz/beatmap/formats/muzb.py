@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+from __future__ import unicode_literals
+
+import logging, struct, sys, os
+from array import array
+log = logging.getLogger(__name__)
+
+import muz
+import muz.beatmap
+
+name = "μz binary beatmap"
+extensions = ["muzb"]
+inferExtensions = extensions
+locations = ["beatmaps"]
+
+#
+# layout (everything is little-endian):
+#
+#   header      magic, version, metadata count, header size, note count, band count, side table size, note rate
+#   strings     music file name, then metadata as key/value pairs, padded to a multiple of 4 bytes
+#   notes       one record of RECORD_SIZE int32s per note: band, hitTime, holdTime, flags, ref, refOfs
+#   side table  int32s: (note index, SIDE_*, count, values...) for every note with varBands/refVarOfs
+#
+# the header size includes the strings, so the (aligned) note records can be located without parsing them
+#
+
+MAGIC = b"MUZB"
+VERSION = 1
+
+HEADER = struct.Struct(b"<4sHHIIIId")
+STRLEN = struct.Struct(b"<I")
+
+RECORD_SIZE = 6
+
+FLAG_HINT = 1
+
+SIDE_VARBANDS = 0
+SIDE_REFVAROFS = 1
+
+class ParseError(Exception):
+    pass
+
+def intArray(data=b""):
+    a = array(b'i')
+    assert a.itemsize == 4
+
+    a.fromstring(data)
+
+    if sys.byteorder != 'little':
+        a.byteswap()
+
+    return a
+
+def packString(s):
+    s = s.encode('utf-8')
+    return STRLEN.pack(len(s)) + s
+
+def packNotes(bmap):
+    # returns the note records and the side table as little-endian int32 strings
+    notes = bmap.notelist
+    notes.compact()
+
+    records = array(b'i', [0]) * (len(notes) * RECORD_SIZE)
+    side = []
+
+    records[0::RECORD_SIZE] = notes.band
+    records[1::RECORD_SIZE] = notes.hitTime
+    records[2::RECORD_SIZE] = notes.holdTime
+    records[3::RECORD_SIZE] = array(b'i', [FLAG_HINT if h else 0 for h in notes.isHint])
+    records[4::RECORD_SIZE] = notes.ref
+    records[5::RECORD_SIZE] = notes.refOfs
+
+    for kind, column in (SIDE_VARBANDS, notes.varBands), (SIDE_REFVAROFS, notes.refVarOfs):
+        for num, vals in enumerate(column):
+            if vals is not None:
+                side.extend((num, kind, len(vals)))
+                side.extend(vals)
+
+    side = array(b'i', side)
+
+    if sys.byteorder != 'little':
+        records.byteswap()
+        side.byteswap()
+
+    return records.tostring(), side.tostring()
+
+def unpackNotes(bmap, records, side):
+    # the inverse of packNotes, appends the notes to bmap
+    records = intArray(records)
+    side = intArray(side)
+
+    notes = bmap.notelist
+    first = len(notes)
+
+    if records and (min(records[0::RECORD_SIZE]) < 0 or min(records[1::RECORD_SIZE]) < 0):
+        raise ParseError("bad note records")
+
+    # straight into the columns, that's what the format is for
+    notes.extendColumns(
+        band        =   records[0::RECORD_SIZE],
+        hitTime     =   records[1::RECORD_SIZE],
+        holdTime    =   records[2::RECORD_SIZE],
+        ref         =   records[4::RECORD_SIZE],
+        refOfs      =   records[5::RECORD_SIZE],
+        isHint      =   array(b'b', [bool(f & FLAG_HINT) for f in records[3::RECORD_SIZE]]),
+    )
+
+    i = 0
+    while i < len(side):
+        if len(side) - i < 3:
+            raise ParseError("truncated side table")
+
+        num, kind, count = side[i:i + 3]
+
+        if not 0 <= num < len(notes) - first or count < 0 or i + 3 + count > len(side):
+            raise ParseError("bad side table entry at %i" % i)
+
+        vals = side[i + 3:i + 3 + count].tolist()
+        i += 3 + count
+
+        if kind == SIDE_VARBANDS:
+            notes[first + num].varBands = vals
+        elif kind == SIDE_REFVAROFS:
+            notes[first + num].refVarOfs = vals
+        else:
+            log.warning("unknown side table entry type %i ignored", kind)
+
+def sniff(head):
+    return head.startswith(MAGIC)
+
+def probe(fobj, filename, options=None):
+    # a bare read only reads the header
+    return read(fobj, filename, bare=True, options=options)
+
+def read(fobj, filename, bare=False, options=None):
+    header = fobj.read(HEADER.size + STRLEN.size)
+
+    if len(header) < HEADER.size + STRLEN.size:
+        raise ParseError("truncated header")
+
+    magic, version, metacount, hsize, numnotes, numbands, sidesize, rate = HEADER.unpack(header[:HEADER.size])
+
+    if magic != MAGIC:
+        raise ParseError("not a μz binary beatmap")
+
+    if version != VERSION:
+        raise ParseError("unsupported version %i" % version)
+
+    if hsize < len(header):
+        raise ParseError("bad header size")
+
+    strings = header[HEADER.size:] + fobj.read(hsize - len(header))
+
+    if len(strings) != hsize - HEADER.size:
+        raise ParseError("truncated header")
+
+    def unpackString(ofs):
+        if ofs + STRLEN.size > len(strings):
+            raise ParseError("truncated string")
+
+        n, = STRLEN.unpack_from(strings, ofs)
+        ofs += STRLEN.size
+
+        if ofs + n > len(strings):
+            raise ParseError("truncated string")
+
+        return strings[ofs:ofs + n].decode('utf-8'), ofs + n
+
+    music, ofs = unpackString(0)
+    bmap = muz.beatmap.Beatmap(None, numbands, music)
+    bmap.noterate = rate
+
+    for i in xrange(metacount):
+        key, ofs = unpackString(ofs)
+        val, ofs = unpackString(ofs)
+        bmap.meta[key] = val
+
+    if not bare:
+        records = fobj.read(numnotes * RECORD_SIZE * 4)
+        side = fobj.read(sidesize * 4)
+
+        if len(records) != numnotes * RECORD_SIZE * 4 or len(side) != sidesize * 4:
+            raise ParseError("premature EOF")
+
+        unpackNotes(bmap, records, side)
+
+    bmap.applyMeta()
+    return bmap
+
+def write(bmap, fobj, options=None, music=None):
+    # music is the name to store the music under instead of bmap.music, see muz.beatmap.export
+    bmap.fix()
+
+    mus = bmap.music if music is None else music
+    strings = [packString(mus)]
+    for key, val in sorted(bmap.meta.items(), key=lambda p: p[0]):
+        strings.append(packString(key))
+        strings.append(packString(val))
+    strings = b"".join(strings)
+    strings += b"\0" * (-(HEADER.size + len(strings)) % 4)
+
+    records, side = packNotes(bmap)
+
+    fobj.write(HEADER.pack(MAGIC, VERSION, len(bmap.meta), HEADER.size + len(strings), len(bmap), bmap.numbands, len(side) // 4, bmap.noterate))
+    fobj.write(strings)
+    fobj.write(records)
+    fobj.write(side)
+
+    return bmap.name, "%s/%s.%s" % (locations[0], bmap.name, extensions[0]), "%s/%s" % (locations[0], os.path.splitext(mus)[0])
@@ -4,11 +4,10 @@ from __future__ import print_function
 from __future__ import division
 from __future__ import unicode_literals
 
-import re
 import muz
 import muz.beatmap
 import muz.util
-import math
+import math, codecs
 
 name = "osu! beatmap"
 extensions = ["osu"]
@@ -39,83 +38,91 @@ def ARToNoterate(ar):
 
     return 1000.0 / msec
 
-patternSection = re.compile(r'^\[([a-zA-Z0-9]+)\]$')
-patternKeyVal = re.compile(r'^([a-zA-Z0-9]+)\s*:\s*(.*)$')
+# sections that are irrelevant to us; their lines aren't even decoded
+skippedSections = frozenset(("Events", "TimingPoints"))
+
+# sections needed for a bare read, which stops as soon as they've all been read
+bareSections = frozenset(("General", "Metadata", "Difficulty"))
+
+def sniff(head):
+    return head.lstrip(codecs.BOM_UTF8).lstrip().startswith(b"osu file format v")
+
+def probe(fobj, filename, options=None):
+    # a bare read already stops after the sections it needs, which come first in practice
+    return read(fobj, filename, bare=True, options=options)
 
 def read(fobj, filename, bare=False, options=None):
-    buf = b""
     bmap = muz.beatmap.Beatmap(None, 1)
+    notes = bmap.notelist
+    Note = muz.beatmap.Note
     versionOk = False
     section = None
+    skip = False
+    seen = set()
+
+    chunkSize = muz.beatmap.formats.probeChunkSize if bare else 64 * 1024
+
+    for line in muz.util.iterLines(fobj, chunkSize=chunkSize):
+        line = line.strip()
+
+        if not line or line.startswith(b"//"):
+            continue
+
+        if not versionOk:
+            assert b"osu file format v" in line
+            versionOk = True
+            continue
+
+        if line[:1] == b"[" and line[-1:] == b"]" and line[1:-1].isalnum():
+            if bare and seen >= bareSections:
+                break
+
+            section = line[1:-1].decode('ascii')
+            skip = section in skippedSections or (bare and section == "HitObjects")
+            seen.add(section)
+            continue
+
+        if skip:
+            continue
+
+        if section == "HitObjects":
+            vals = line.split(b",")
+            hit = int(vals[2])
+            hold = 0
+
+            if int(vals[3]) & 128:
+                hold = int(vals[5].split(b":", 1)[0]) - hit
+
+            # "human-readable" my ass
+            # let's hope there is no beatmap that sets "CircleSize" AFTER the HitObjects section
+            band = int(int(vals[0]) / (512 / bmap.numbands))
+
+            # maybe CircleSize lied to us...
+            if band >= bmap.numbands:
+                bmap.numbands = band + 1
+
+            notes.append(Note(band, hit, hold))
+            continue
+
+        key, sep, val = line.partition(b":")
+        key = key.rstrip()
+
+        if not sep or not key.isalnum():
+            raise SyntaxError("failed to parse %s in an osu! beatmap" % repr(line.decode('utf-8')))
+
+        key = key.decode('ascii')
+        val = val.lstrip().decode('utf-8')
+
+        if section == "General":
+            if key == "AudioFilename":
+                bmap.music = val.replace("\\", "/")
+        elif section == "Difficulty":
+            if key == "CircleSize":
+                bmap.numbands = int(float(val))
+            elif key == "ApproachRate":
+                bmap.noterate = ARToNoterate(float(val))
 
-    while True:
-        byte = fobj.read(1)
-
-        if not byte:
-            break
-
-        if byte in (b'\r', b'\n'):
-            buf = buf.decode('utf-8').strip()
-
-            if not buf or  buf.startswith("//"):
-                buf = b""
-                continue
-
-            if not versionOk:
-                assert "osu file format v" in buf
-                versionOk = True
-                buf = b""
-                continue
-
-            s = patternSection.findall(buf)
-            if s:
-                section = s[0]
-                buf = b""
-                continue
-
-            if section == "Events" or section == "TimingPoints" or (bare and section == "HitObjects"):
-                buf = b""
-                continue
-            elif section == "HitObjects":
-                vals = buf.split(',')
-                hit = int(vals[2])
-                hold = 0
-
-                if int(vals[3]) & 128:
-                    hold = int(vals[5].split(":")[0]) - hit
-
-                # "human-readable" my ass
-                # let's hope there is no beatmap that sets "CircleSize" AFTER the HitObjects section
-                band = int(int(vals[0]) / (512 / bmap.numbands))
-
-                # maybe CircleSize lied to us...
-                bmap.numbands = max(bmap.numbands, band + 1)
-
-                bmap.append(muz.beatmap.Note(band, hit, hold))
-
-                buf = b""
-                continue
-            else:
-                s = patternKeyVal.findall(buf)
-                if s:
-                    key, val = s[0]
-
-                    if section == "General":
-                        if key == "AudioFilename":
-                            bmap.music = val.replace("\\", "/")
-                    elif section == "Difficulty":
-                        if key == "CircleSize":
-                            bmap.numbands = int(float(val))
-                        elif key == "ApproachRate":
-                            bmap.noterate = ARToNoterate(float(val))
-
-                    bmap.meta["osu.%s.%s" % (section, key)] = val
-                    buf = b""
-                    continue
-
-            raise SyntaxError("failed to parse %s in an osu! beatmap" % repr(buf))
-
-        buf += byte
+        bmap.meta["osu.%s.%s" % (section, key)] = val
 
     bmap.meta["Music.Name"] = bmap.meta["osu.Metadata.TitleUnicode"]
     bmap.meta["Music.Name.ASCII"] = bmap.meta["osu.Metadata.Title"]
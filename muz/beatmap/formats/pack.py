@@ -16,6 +16,9 @@ extensions = ["pk3", "zip", "osz"]
 inferExtensions = []
 locations = ["."]
 
+# reading a pack mounts it into the vfs, so the result must never come from the beatmap cache
+cacheable = False
+
 class PackError(Exception):
     pass
 
@@ -36,7 +39,7 @@ def read(fobj, filename, bare=False, options=None):
     if pref:
         pref = pref + muz.vfs.VPATH_SEP
 
-    for d, f, v in p.walk():
+    for d, f, v in p.walk(exts=muz.beatmap.formats.importersByExt):
         n = muz.beatmap.nameFromPath(pref + "%s%s%s" % (d, muz.vfs.VPATH_SEP, f))
 
         if not n:
@@ -4,10 +4,14 @@ from __future__ import print_function
 from __future__ import division
 from __future__ import unicode_literals
 
-import logging, re, os
+import logging, re, os, codecs
 log = logging.getLogger(__name__)
 
 import json
+from io import BytesIO
+from operator import itemgetter
+from itertools import izip
+import muz.util
 import muz.beatmap
 
 name = "SIFTrain beatmap"
@@ -49,44 +53,42 @@ def difficultyToNoterate(d):
         4: 0.8,
     }.get(d, 1.0)
 
+# The exporter renders the notes itself rather than building a dict for each of them. It has to come out
+# exactly as json.dumps would have it, so the key order is taken from a dict with the same keys.
+# Floats are %r'd, which is what json does with them.
+# Rendering to bytes skips a lot of unicode coercion.
+NOTE_FORMATS = {
+    "timing_sec"    : "%r",
+    "effect"        : "%i",
+    "effect_value"  : "%r",
+    "position"      : "%i",
+}
+
+NOTE_KEYS = tuple(NOTE_FORMATS.keys())
+NOTE_TEMPLATE = ("{%s}" % ",".join('"%s":%s' % (key, NOTE_FORMATS[key]) for key in NOTE_KEYS)).encode('ascii')
+noteValues = itemgetter(*(("timing_sec", "effect", "effect_value", "position").index(key) for key in NOTE_KEYS))
+
 filenamePattern = re.compile(r'^(.*)_(easy|normal|hard|expert)\.rs$')
 musicFilePattern = re.compile(r'.*\.(mp3|ogg|wav)$')
 
-def read(fobj, filename, bare=False, options=None):
-    raw = fobj.read().decode('utf-8')
-    data = json.loads(raw[raw.index('{'):])
-    songinfo = data["song_info"][0]
+def sniff(head):
+    return head.lstrip(codecs.BOM_UTF8).lstrip().startswith(b"{")
+
+# the top-level members probe parses; of "song_info" (the notes), only notes_speed is picked out
+probeKeys = frozenset(("song_name", "difficulty", "difficulty_name", "music_file", "rank_info", "lead_in"))
 
+def musicName(data, filename):
     if "music_file" in data:
-        mus = data["music_file"]
-    elif filename is not None:
+        return data["music_file"]
+
+    if filename is not None:
         match = filenamePattern.findall(filename)
         if match:
-            mus = match[0][0] + '.ogg'
-        else:
-            mus = "%s.ogg" % data["song_name"].replace("/", "_").encode('utf-8')
-    else:
-        mus = "%s.ogg" % data["song_name"].replace("/", "_").encode('utf-8')
-
-    bmap = muz.beatmap.Beatmap(None, 9, "../soundfiles/" + mus)
-
-    if not bare:
-        if "___muz_time_offset" in data: # non-"standard"
-            timeofs = int(data["___muz_time_offset"])
-        else:
-            timeofs = 0
-
-        for note in songinfo["notes"]:
-            hitTime = int(note["timing_sec"] * 1000) + timeofs
-            holdTime = 0
-            band = 9 - int(note["position"])
-            effect = int(note["effect"])
+            return match[0][0] + '.ogg'
 
-            if effect & FLAG_HOLD:
-                holdTime = int(note["effect_value"] * 1000)
-
-            bmap.append(muz.beatmap.Note(band, hitTime, holdTime))
+    return "%s.ogg" % data["song_name"].replace("/", "_").encode('utf-8')
 
+def readMeta(bmap, data):
     if "song_name" in data:
         bmap.meta["Music.Name"] = data["song_name"]
         bmap.meta["siftrain.song_name"] = data["song_name"]
@@ -104,9 +106,12 @@ def read(fobj, filename, bare=False, options=None):
         bmap.meta["siftrain.difficulty"] = data["difficulty"]
         bmap.noterate = difficultyToNoterate(data["difficulty"])
 
-    if "notes_speed" in songinfo:
-        bmap.meta["siftrain.song_info.notes_speed"] = songinfo["notes_speed"]
-        bmap.noterate = 1.0 / songinfo["notes_speed"]
+    if "song_info" in data:
+        songinfo = data["song_info"][0]
+
+        if "notes_speed" in songinfo:
+            bmap.meta["siftrain.song_info.notes_speed"] = songinfo["notes_speed"]
+            bmap.noterate = 1.0 / songinfo["notes_speed"]
 
     if "rank_info" in data:
         ranks = len(data["rank_info"])
@@ -116,13 +121,63 @@ def read(fobj, filename, bare=False, options=None):
     if "lead_in" in data:
         bmap.meta["siftrain.lead_in"] = data["lead_in"]
 
+def probe(fobj, filename, options=None):
+    # JSON members can come in any order, so this has to get to the end, but the notes are only skipped over
+    data = {}
+
+    for key, raw in muz.util.iterJSONMembers(fobj, muz.beatmap.formats.probeChunkSize, keys=probeKeys | {"song_info"}):
+        if key in probeKeys:
+            data[key] = json.loads(raw.decode('utf-8'))
+        elif key == "song_info":
+            songinfo = {}
+
+            # the members of its first (and only) element
+            for k, v in muz.util.iterJSONMembers(BytesIO(raw), len(raw), keys=("notes_speed",)):
+                if k == "notes_speed":
+                    songinfo[k] = json.loads(v.decode('utf-8'))
+
+            data[key] = [songinfo]
+
+    bmap = muz.beatmap.Beatmap(None, 9, "../soundfiles/" + musicName(data, filename))
+    readMeta(bmap, data)
     bmap.applyMeta()
     return bmap
 
-def write(bmap, fobj, options=None):
+def read(fobj, filename, bare=False, options=None):
+    if bare:
+        return probe(fobj, filename, options=options)
+
+    raw = fobj.read().decode('utf-8')
+    data = json.loads(raw[raw.index('{'):])
+    songinfo = data["song_info"][0]
+
+    bmap = muz.beatmap.Beatmap(None, 9, "../soundfiles/" + musicName(data, filename))
+
+    if "___muz_time_offset" in data: # non-"standard"
+        timeofs = int(data["___muz_time_offset"])
+    else:
+        timeofs = 0
+
+    for note in songinfo["notes"]:
+        hitTime = int(note["timing_sec"] * 1000) + timeofs
+        holdTime = 0
+        band = 9 - int(note["position"])
+        effect = int(note["effect"])
+
+        if effect & FLAG_HOLD:
+            holdTime = int(note["effect_value"] * 1000)
+
+        bmap.append(muz.beatmap.Note(band, hitTime, holdTime))
+
+    readMeta(bmap, data)
+    bmap.applyMeta()
+    return bmap
+
+def write(bmap, fobj, options=None, music=None):
+    # music is the name to store the music under instead of the one derived from the beatmap's name (or meta),
+    # see muz.beatmap.export
     bmap.fix()
     meta = bmap.meta
-    notes = []
 
     root = {
         "song_name"         : meta["siftrain.song_name"] or meta["Music.Name"] or meta["Music.Name.ASCII"],
@@ -130,7 +185,7 @@ def write(bmap, fobj, options=None):
                               if meta["siftrain.difficulty"] else
                               DIFFICULTY_TO_ID[meta["Beatmap.Variant"].lower().capitalize()],
         "song_info"         : [{
-            "notes"         : notes
+            "notes"         : []
         }]
     }
 
@@ -143,24 +198,22 @@ def write(bmap, fobj, options=None):
     if bmap.meta["siftrain.lead_in"]:
         root["lead_in"] = float(meta["siftrain.lead_in"])
 
-    p = None
-    pn = None
-
-    for note in bmap:
-        n = {
-            "timing_sec"    : note.hitTime / 1000.0,
-            "effect"        : FLAG_HOLD if note.holdTime else FLAG_NORMAL,
-            "effect_value"  : (note.holdTime / 1000.0) if note.holdTime else 2,
-            "position"      : 9 - note.band
-        }
+    # fix() leaves the notes compacted, so the columns are in order
+    notes = bmap.notelist
+    hitTimes = notes.hitTime
+    effects = [FLAG_HOLD if holdTime else FLAG_NORMAL for holdTime in notes.holdTime]
 
-        if p is not None and note.hitTime == pn.hitTime:
-            p["effect"] |= FLAG_SIMULT_START
-            n["effect"] |= FLAG_SIMULT_START
+    for i in xrange(1, len(hitTimes)):
+        if hitTimes[i] == hitTimes[i - 1]:
+            effects[i - 1] |= FLAG_SIMULT_START
+            effects[i] |= FLAG_SIMULT_START
 
-        p = n
-        pn = note
-        notes.append(n)
+    rendered = b",".join([NOTE_TEMPLATE % noteValues((
+        hitTime / 1000.0,
+        effect,
+        holdTime / 1000.0 if holdTime else 2,
+        9 - band,
+    )) for hitTime, holdTime, band, effect in izip(hitTimes, notes.holdTime, notes.band, effects)])
 
     if meta["siftrain.song_info.notes_speed"]:
         root["song_info"][0]["notes_speed"] = float(meta["siftrain.song_info.notes_speed"])
@@ -184,6 +237,15 @@ def write(bmap, fobj, options=None):
         if musicFilePattern.match(musname):
             musname = os.path.splitext(musname)[0]
 
-    fobj.write(json.dumps(root, fobj, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+    if music is not None:
+        root["music_file"] = music
+        musname = os.path.splitext(music)[0]
+
+    # "notes":[] can't appear anywhere else, quotes inside strings are escaped
+    out = json.dumps(root, ensure_ascii=False, separators=(',', ':'))
+    if isinstance(out, unicode):
+        out = out.encode('utf-8')
+
+    fobj.write(out.replace(b'"notes":[]', b'"notes":[' + rendered + b']', 1))
 
     return newname, "%s/%s.%s" %(locations[0], newname, extensions[0]), "beatmaps/soundfiles/%s" % musname
@@ -4,7 +4,7 @@ from __future__ import print_function
 from __future__ import division
 from __future__ import unicode_literals
 
-import json, urllib2, cookielib, shutil, os, logging, sys
+import json, urllib2, cookielib, shutil, os, logging, sys, codecs
 from StringIO import StringIO
 
 import muz
@@ -22,31 +22,45 @@ extensions = ["json"]
 inferExtensions = extensions
 locations = ["beatmaps"]
 
-def read(fobj, filename, bare=False, options=None):
-    raw = fobj.read().decode('utf-8', errors='ignore')
-    data = json.loads(raw[raw.index('{'):])
-    musfile = data["audiofile"]
+def sniff(head):
+    return head.lstrip(codecs.BOM_UTF8).lstrip().startswith(b"{")
 
+def musicName(musfile):
     if not musfile.endswith('.mp3') and not musfile.endswith('.ogg'):
         musfile = musfile + '.mp3'
 
-    bmap = muz.beatmap.Beatmap(None, 9, musfile)
+    return musfile
+
+def probe(fobj, filename, options=None):
+    # the music file is all there is to know, stop as soon as it turns up
+    for key, raw in muz.util.iterJSONMembers(fobj, muz.beatmap.formats.probeChunkSize):
+        if key == "audiofile":
+            return muz.beatmap.Beatmap(None, 9, musicName(json.loads(raw.decode('utf-8', errors='ignore'))))
+
+    raise KeyError("audiofile")
+
+def read(fobj, filename, bare=False, options=None):
+    if bare:
+        return probe(fobj, filename, options=options)
+
+    raw = fobj.read().decode('utf-8', errors='ignore')
+    data = json.loads(raw[raw.index('{'):])
 
-    if not bare:
-        ofs = config["offset"]
+    bmap = muz.beatmap.Beatmap(None, 9, musicName(data["audiofile"]))
+    ofs = config["offset"]
 
-        for lane in data["lane"]:
-            for note in lane:
-                hitTime = note["starttime"] + ofs
-                band = note["lane"]
-                holdTime = 0
+    for lane in data["lane"]:
+        for note in lane:
+            hitTime = note["starttime"] + ofs
+            band = note["lane"]
+            holdTime = 0
 
-                # there's also a "hold" key but it seems to be always false
-                if note["longnote"]:
-                    holdTime = int(note["endtime"] - hitTime + ofs)
+            # there's also a "hold" key but it seems to be always false
+            if note["longnote"]:
+                holdTime = int(note["endtime"] - hitTime + ofs)
 
-                hitTime = int(hitTime)
-                bmap.append(muz.beatmap.Note(band, hitTime, holdTime))
+            hitTime = int(hitTime)
+            bmap.append(muz.beatmap.Note(band, hitTime, holdTime))
 
     bmap.fix()
 
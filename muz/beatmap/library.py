@@ -0,0 +1,175 @@
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+from __future__ import unicode_literals
+
+import os, logging, sqlite3
+log = logging.getLogger(__name__)
+
+import muz
+import muz.vfs as vfs
+
+from . import formats
+from .misc import load, listPaths
+
+COLUMNS = (
+    "vpath", "name", "importer", "title",
+    "musicname", "artist", "variant", "author",
+    "notes", "bands", "duration", "music",
+    "stamp", "error",
+)
+
+SCHEMA = """
+    CREATE TABLE beatmaps (
+        vpath       TEXT PRIMARY KEY,
+        name        TEXT NOT NULL,
+        importer    TEXT,
+        title       TEXT,
+        musicname   TEXT,
+        artist      TEXT,
+        variant     TEXT,
+        author      TEXT,
+        notes       INTEGER,
+        bands       INTEGER,
+        duration    INTEGER,
+        music       TEXT,
+        stamp       TEXT,
+        error       TEXT
+    )
+"""
+
+SEARCHABLE = ("name", "title", "musicname", "artist", "variant", "author")
+
+class BeatmapLibrary(object):
+    # A persistent summary of every beatmap in the vfs (names, metadata, note counts, ...), so that listing and
+    # searching don't have to parse anything. refresh() only parses the beatmaps whose fingerprint changed.
+
+    # bump this whenever the schema changes
+    version = 1
+
+    def __init__(self):
+        self.path = None
+        self._db = None
+
+    def open(self, path):
+        self.close()
+        self.path = path
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    @property
+    def db(self):
+        if self._db is None:
+            d = os.path.dirname(self.path)
+            if not os.path.isdir(d):
+                os.makedirs(d)
+
+            db = sqlite3.connect(self.path)
+
+            if db.execute("PRAGMA user_version").fetchone()[0] != self.version:
+                log.info("(re)creating the beatmap library at %s", self.path)
+                db.execute("DROP TABLE IF EXISTS beatmaps")
+                db.execute(SCHEMA)
+                db.execute("PRAGMA user_version = %i" % self.version)
+                db.commit()
+
+            self._db = db
+
+        return self._db
+
+    def scan(self, name, vpath, stamp):
+        row = dict.fromkeys(COLUMNS)
+        row.update(vpath=vpath, name=name, stamp=stamp)
+
+        importer = formats.importersByExt.get(vpath.rsplit(".", 1)[-1])
+        if importer is not None:
+            row["importer"] = importer.__name__
+
+        try:
+            bmap = load(name)
+        except Exception as e:
+            log.warning("failed to load beatmap %s: %s", name, e)
+            log.debug("dumping traceback", exc_info=True)
+            row["error"] = unicode(e)
+            return row
+
+        meta = bmap.meta
+        row.update(
+            title=bmap.name,
+            musicname=meta["Music.Name"] or meta["Music.Name.ASCII"],
+            artist=meta["Music.Artist"] or meta["Music.Artist.ASCII"],
+            variant=meta["Beatmap.Variant"],
+            author=meta["Beatmap.Author"],
+            notes=len(bmap),
+            bands=bmap.numbands,
+            duration=max([note.hitTime + note.holdTime for note in bmap] or [0]),
+            music=bmap.music,
+        )
+
+        return row
+
+    def refresh(self, root=None):
+        if root is None:
+            root = vfs.root
+
+        db = self.db
+        known = dict(db.execute("SELECT vpath, stamp FROM beatmaps"))
+        seen = set()
+        updated = 0
+
+        for name, vpath in listPaths(root):
+            seen.add(vpath)
+
+            try:
+                fingerprint = root.locate(vpath).fingerprint
+            except Exception:
+                log.debug("couldn't fingerprint %s", repr(vpath), exc_info=True)
+                fingerprint = None
+
+            # beatmaps that can't be fingerprinted are scanned every time
+            stamp = None if fingerprint is None else repr(fingerprint)
+
+            if stamp is not None and known.get(vpath) == stamp:
+                continue
+
+            row = self.scan(name, vpath, stamp)
+            db.execute("INSERT OR REPLACE INTO beatmaps (%s) VALUES (%s)" % (
+                ", ".join(COLUMNS), ", ".join("?" * len(COLUMNS))
+            ), [row[c] for c in COLUMNS])
+            updated += 1
+
+        stale = [(p,) for p in known if p not in seen]
+        db.executemany("DELETE FROM beatmaps WHERE vpath = ?", stale)
+        db.commit()
+
+        log.info("beatmap library refreshed: %i updated, %i removed, %i total", updated, len(stale), len(seen))
+
+    def query(self, sql, args=()):
+        # rows as dicts; sqlite3.Row won't take unicode keys on python 2
+        cursor = self.db.execute(sql, args)
+        cols = [d[0].decode('utf-8') if isinstance(d[0], bytes) else d[0] for d in cursor.description]
+        return [dict(zip(cols, r)) for r in cursor]
+
+    def list(self):
+        return self.query("SELECT * FROM beatmaps ORDER BY name")
+
+    def search(self, query):
+        # every word of the query has to appear in at least one of the SEARCHABLE columns (case-insensitively)
+        where = []
+        args = []
+
+        for word in query.split():
+            word = "%%%s%%" % word.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            where.append("(%s)" % " OR ".join("%s LIKE ? ESCAPE '\\'" % c for c in SEARCHABLE))
+            args.extend([word] * len(SEARCHABLE))
+
+        sql = "SELECT * FROM beatmaps"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+
+        return self.query(sql + " ORDER BY name", args)
+
+beatmapLibrary = BeatmapLibrary()
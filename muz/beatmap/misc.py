@@ -4,7 +4,7 @@ from __future__ import print_function
 from __future__ import division
 from __future__ import unicode_literals
 
-import logging, sys, os
+import logging, sys, os, collections, hashlib
 from io import BytesIO
 
 log = logging.getLogger(__name__)
@@ -13,6 +13,7 @@ import muz
 import muz.vfs as vfs
 
 from . import formats
+from .cache import beatmapCache
 
 def handleExportArgs(parser, argv, namespace, mapfunc):
     g = parser.add_argument_group(title='export options')
@@ -80,49 +81,147 @@ def main(mapfunc, defaultPos=0, defaultLoopLimit=0, defaultFormat='pack'):
     finally:
         muz.main.frontend.shutdown()
 
-def load(name, bare=False, options=None):
-    name = str(name)
-    node = None
+SNIFF_SIZE = 512
+
+def listDir(path):
+    # Returns the names in a vfs (or, for absolute paths, real) directory and a function to get the node for one
+    # of them, or (None, None) if there's no such directory. Nothing is logged or raised for missing directories.
+
+    if path.startswith(os.path.sep) and os.path.isdir(path):
+        return set(vfs.dirCache.listDir(path)), lambda f: vfs.RealFile(os.path.join(path, f))
+
+    node = vfs.root
+
+    for part in vfs.iterPath(vfs.normalizePath(path)):
+        if part not in node:
+            return None, None
+        node = node[part]
+
+    if not node.isDir:
+        return None, None
+
+    return set(node), node.__getitem__
+
+def sniff(node, candidates):
+    # picks the first of the candidate importers that recognizes the beginning of node
+    f = node.open()
+
+    try:
+        head = f.read(SNIFF_SIZE)
+    finally:
+        f.close()
+
+    for importer in candidates:
+        if hasattr(importer, "sniff") and importer.sniff(head):
+            return importer
+
+    return None
+
+def resolve(name):
+    # Finds the file a beatmap name refers to and the importer to read it with, scanning every candidate
+    # directory once. The extension decides the importer; the contents are only looked at if that's ambiguous.
+    # Returns (importer, path, node).
+
+    importers = formats.importers
     wantext = None
+    exact = False
 
     if "." in name:
         a = name.split(".")
         if " " not in a[-1] and "/" not in a[-1]:
             wantext = a[-1]
-            name = ".".join(a[:-1])
 
-    log.info("attempting to load beatmap %s", repr(name))
-
-    for ext, importer in muz.beatmap.formats.importersByInferExt.items():
-        if wantext is not None and ext != wantext:
-            continue
+            if wantext in formats.importersByInferExt:
+                name = ".".join(a[:-1])
+            else:
+                # not an extension we know, look for the file as named and go by its contents
+                wantext = None
+                exact = True
 
-        found = False
-        paths = []
+    if vfs.VPATH_SEP in name:
+        subdir, stem = name.rsplit(vfs.VPATH_SEP, 1)
+    else:
+        subdir, stem = "", name
 
-        if name.startswith(vfs.VPATH_SEP) or name.startswith(os.path.sep):
-            paths.append("%s.%s" % (name, ext))
-        else:
+    if name.startswith(vfs.VPATH_SEP) or name.startswith(os.path.sep):
+        dirs = [(None, subdir or vfs.VPATH_SEP)]
+    else:
+        dirs = []
+        for importer in importers:
             for location in importer.locations:
-                paths.append("%s/%s.%s"  % (location, name, ext))
+                d = (location, vfs.joinPath(location, subdir) if subdir else location)
+                if d not in dirs:
+                    dirs.append(d)
+
+    # (path, getnode, importers that could read it) for every matching file, in order of preference
+    candidates = collections.OrderedDict()
+
+    for location, path in dirs:
+        entries, getnode = listDir(path)
 
-        for path in paths:
-            try:
-                node = vfs.locate(path)
-            except Exception:
-                log.debug("couldn't load beatmap %s with the %s importer", repr(path), repr(importer.__name__), exc_info=True)
+        if not entries:
+            continue
+
+        for importer in importers:
+            if location is not None and location not in importer.locations:
+                continue
+
+            if exact:
+                fnames = [stem]
             else:
-                log.info("loading beatmap %s (%s) with the %s importer", repr(name), repr(path), repr(importer.__name__))
-                found = True
-                break
+                fnames = ["%s.%s" % (stem, ext) for ext in importer.inferExtensions if wantext in (None, ext)]
 
-        if found:
-            break
+            for fname in fnames:
+                if fname in entries:
+                    fpath = vfs.joinPath(path, fname)
+                    candidates.setdefault(fpath, (getnode, fname, []))[2].append(importer)
 
-    if node is None:
+    if not candidates:
         raise RuntimeError("No importer available for beatmap %s" % name)
 
-    bm = importer.read(node.open(), node.name, bare=bare, options=options)
+    if len(candidates) == 1 and not exact:
+        fpath, (getnode, fname, possible) = candidates.items()[0]
+        return possible[0], fpath, getnode(fname)
+
+    log.info("sniffing %s to resolve beatmap %s", ", ".join(repr(p) for p in candidates), repr(name))
+
+    for fpath, (getnode, fname, possible) in candidates.items():
+        try:
+            node = getnode(fname)
+            importer = sniff(node, possible)
+        except Exception:
+            log.debug("couldn't sniff %s", repr(fpath), exc_info=True)
+            continue
+
+        if importer is not None:
+            return importer, fpath, node
+
+    if exact:
+        raise RuntimeError("No importer recognizes beatmap %s" % name)
+
+    # nothing looks right, just go by the extension
+    fpath, (getnode, fname, possible) = candidates.items()[0]
+    return possible[0], fpath, getnode(fname)
+
+def load(name, bare=False, options=None):
+    name = str(name)
+
+    log.info("attempting to load beatmap %s", repr(name))
+
+    importer, path, node = resolve(name)
+    log.info("loading beatmap %s (%s) with the %s importer", repr(name), repr(path), repr(importer.__name__))
+
+    if "." in name:
+        a = name.split(".")
+        if a[-1] in formats.importersByInferExt:
+            name = ".".join(a[:-1])
+
+    if bare and hasattr(importer, "probe"):
+        # probes only read a few kilobytes, not worth a trip to the cache
+        bm = importer.probe(node.open(), node.name, options=options)
+    else:
+        bm = beatmapCache.read(importer, node, path, bare=bare, options=options)
+
     if bm.vfsNode is None:
         bm.vfsNode = node
 
@@ -144,6 +243,50 @@ def nameFromPath(path):
 
     return None
 
+def listNames(root=None, force=True):
+    for name, path in listPaths(root, force=force):
+        yield name
+
+def listPaths(root=None, force=True):
+    # like listNames, but yields (name, vpath) pairs
+    if root is None:
+        root = vfs.root
+
+    exts = muz.beatmap.formats.importersByExt
+    locations = set(vfs.normalizePath(l) for importer in exts.values() for l in importer.locations)
+
+    # nameFromPath can't match anything at the top level, and nested locations are covered by their parents
+    locations = [l for l in locations if l and not any(l.startswith(o + vfs.VPATH_SEP) for o in locations)]
+
+    for location in sorted(locations):
+        try:
+            node = root.locate(location)
+        except Exception:
+            log.debug("beatmap location %s doesn't exist", repr(location), exc_info=True)
+            continue
+
+        for path, obj, _ in node.walk(pref=location + vfs.VPATH_SEP, exts=exts, force=force):
+            name = nameFromPath(path + obj)
+
+            if name:
+                yield name, path + obj
+
+def musicKey(node):
+    # Something that identifies the contents of a music file, or None if that can't be told without reading all of it
+    fingerprint = node.fingerprint
+
+    if fingerprint is None:
+        return None
+
+    return repr(fingerprint).encode('utf-8')
+
+def exportMap(format, bmap, options, ext, music):
+    s = BytesIO()
+    newname, mappath, muspath = format.write(bmap, s, options=options, music=music)
+    s.seek(0)
+
+    return newname, mappath, "%s%s" % (muspath, ext), s
+
 def export(*bmaps, **kwargs):
     format = formats.muz
     packtype = vfs.VirtualPack
@@ -171,15 +314,41 @@ def export(*bmaps, **kwargs):
 
     pack = packtype(name, ifExists=ifexists)
 
-    for bmap in bmaps:
-        s = BytesIO()
-        newname, mappath, muspath = format.write(bmap, s, options=options)
-        s.seek(0)
+    # muspath -> (music identity, the name it was stored under)
+    stored = {}
+    byKey = {}
 
-        muspath = "%s%s" % (muspath, os.path.splitext(bmap.music)[-1])
+    for num, bmap in enumerate(bmaps):
+        node = bmap.musicVfsNode
+        key = musicKey(node)
+
+        if key is None:
+            # not worth reading the whole file to find out, just don't share it
+            key = ("unknown music %i" % num).encode('utf-8')
+
+        ext = os.path.splitext(bmap.music)[-1]
+
+        # every format is told what to call the music, so that beatmaps sharing it can point at the same copy
+        if key in byKey:
+            music = stored[byKey[key]][1]
+        else:
+            music = os.path.basename(bmap.music)
+
+        newname, mappath, muspath, s = exportMap(format, bmap, options, ext, music)
+
+        if muspath in stored and stored[muspath][0] != key:
+            # a different song that happens to have the same name
+            music = "%s.%s%s" % (os.path.splitext(music)[0], hashlib.sha1(key).hexdigest()[:8], ext)
+            newname, mappath, muspath, s = exportMap(format, bmap, options, ext, music)
+
+        if muspath in stored:
+            log.info("beatmap %s shares its music with another beatmap", bmap.name)
+        else:
+            with node.open() as mus:
+                pack.addFile(muspath, mus)
 
-        with bmap.musicFile as mus:
-            pack.addFile(muspath, mus)
+            stored[muspath] = (key, music)
+            byKey.setdefault(key, muspath)
 
         pack.addFile(mappath, s)
 
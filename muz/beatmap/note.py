@@ -1,52 +1,153 @@
-
 from __future__ import absolute_import
 from __future__ import print_function
 from __future__ import division
 from __future__ import unicode_literals
 
+import collections
+from array import array
+
 class NoteError(Exception):
     pass
 
 class ReferenceError(NoteError):
     pass
 
+# stored in int32 arrays by NoteArray
+INT_COLUMNS = ("band", "hitTime", "holdTime", "ref", "refOfs")
+
+# isHint is a byte array, varBands and refVarOfs are lists that are None for most notes
+COLUMNS = INT_COLUMNS + ("isHint", "varBands", "refVarOfs")
+
+class NoteRow(object):
+    # Where a note that isn't in a NoteArray keeps its values: one-element columns, so that Note doesn't care
+    __slots__ = COLUMNS
+
+    def writable(self, name):
+        return getattr(self, name)
+
 class Note(object):
+    # A view of one row of a NoteArray. Notes created directly carry their own values until they're added to one.
+
+    __slots__ = ("_array", "_row", "refObj")
+
+    # the values live in the columns of _array, row _row. These are spelled out for speed, they're accessed a lot.
+
+    @property
+    def band(self):
+        return self._array.band[self._row]
+
+    @band.setter
+    def band(self, v):
+        self._array.writable("band")[self._row] = int(v)
+
+    @property
+    def hitTime(self):
+        return self._array.hitTime[self._row]
+
+    @hitTime.setter
+    def hitTime(self, v):
+        self._array.writable("hitTime")[self._row] = int(v)
+
+    @property
+    def holdTime(self):
+        return self._array.holdTime[self._row]
+
+    @holdTime.setter
+    def holdTime(self, v):
+        self._array.writable("holdTime")[self._row] = int(v)
+
+    @property
+    def ref(self):
+        return self._array.ref[self._row]
+
+    @ref.setter
+    def ref(self, v):
+        self._array.writable("ref")[self._row] = int(v)
+
+    @property
+    def refOfs(self):
+        return self._array.refOfs[self._row]
+
+    @refOfs.setter
+    def refOfs(self, v):
+        self._array.writable("refOfs")[self._row] = int(v)
+
+    @property
+    def isHint(self):
+        return bool(self._array.isHint[self._row])
+
+    @isHint.setter
+    def isHint(self, v):
+        self._array.writable("isHint")[self._row] = bool(v)
+
+    # MAY be None, this is not a mistake
+    # Empty sequence expands to "any band"
+
+    @property
+    def varBands(self):
+        return self._array.varBands[self._row]
+
+    @varBands.setter
+    def varBands(self, v):
+        self._array.writable("varBands")[self._row] = v
+
+    @property
+    def refVarOfs(self):
+        return self._array.refVarOfs[self._row]
+
+    @refVarOfs.setter
+    def refVarOfs(self, v):
+        self._array.writable("refVarOfs")[self._row] = v
+
     def __init__(self, band, hitTime, holdTime, varBands=None, ref=-1, refOfs=0, refVarOfs=None, isHint=False):
         try:
-            self.hitTime = int(hitTime)
-            assert self.hitTime >= 0
+            hitTime = int(hitTime)
+            assert hitTime >= 0
         except Exception:
             raise NoteError("bad hit time")
 
         try:
-            self.holdTime = int(holdTime)
+            holdTime = int(holdTime)
 
             if isHint:
-                if self.holdTime < 0:
-                    self.holdTime = -1
-            elif self.holdTime < 0:
-                assert self.holdTime >= 0
+                if holdTime < 0:
+                    holdTime = -1
+            elif holdTime < 0:
+                assert holdTime >= 0
         except Exception:
             raise NoteError("bad hold time")
 
         try:
-            self.band = int(band)
-            assert self.band >= 0
+            band = int(band)
+            assert band >= 0
         except Exception:
             raise NoteError("bad band number")
 
-        # MAY be None, this is not a mistake
-        # Empty sequence expands to "any band"
-        self.varBands = varBands
-        self.refVarOfs = refVarOfs
-
-        self.ref = ref
-        self.refOfs = refOfs
+        row = NoteRow()
+        row.band = [band]
+        row.hitTime = [hitTime]
+        row.holdTime = [holdTime]
+        row.ref = [int(ref)]
+        row.refOfs = [int(refOfs)]
+        row.isHint = [bool(isHint)]
+        row.varBands = [varBands]
+        row.refVarOfs = [refVarOfs]
 
-        self.num = 0
+        self._array = row
+        self._row = 0
         self.refObj = None
 
-        self.isHint = isHint
+    @property
+    def num(self):
+        # the position in the NoteArray
+        if isinstance(self._array, NoteRow):
+            return 0
+        return self._array.index(self)
+
+    @property
+    def values(self):
+        a, row = self._array, self._row
+        return tuple(getattr(a, name)[row] for name in COLUMNS)
 
     def resolveRef(self, bmap):
         if self.ref < 0:
@@ -83,3 +184,364 @@ class Note(object):
             refVarOfs   =   dup(self.refVarOfs),
             isHint      =   self.isHint
         )
+
+class NoteArray(collections.MutableSequence):
+    # Notes stored column by column (see COLUMNS), which is a lot smaller and faster to copy and sort than a list of
+    # objects. Items are Note views of the rows, created on demand and kept, so the same note is always the same object.
+    #
+    # A row never moves while there are views of it, except in compact() (and sort(), which compacts). The order of
+    # the notes is kept separately (rows), so inserting and removing notes doesn't have to touch the views. Removed
+    # notes leave their rows behind until there are more of those than live ones; views of removed notes keep
+    # their values. Adding a note that isn't in any NoteArray turns it into a view of the new row, notes from other
+    # arrays are copied.
+    #
+    # copy() shares the columns with the copy, whichever changes a column first gets its own (see writable). The
+    # varBands and refVarOfs lists themselves stay shared, so replace them instead of changing them in place.
+
+    def __init__(self, source=None):
+        for name in INT_COLUMNS:
+            setattr(self, name, array(b'i'))
+
+        self.isHint = array(b'b')
+        self.varBands = []
+        self.refVarOfs = []
+
+        self._rows = array(b'i')
+        self._alive = array(b'b')
+        self._views = {}
+
+        # names of the columns (and _rows, _alive) that are shared with a copy
+        self._shared = set()
+
+        # whether _rows is just 0, 1, 2, ..., i.e. every row is alive and row number == position
+        self._compact = True
+
+        # row -> position when not compact, made by index() and kept up to date until notes are inserted or removed
+        # in the middle. Removed rows may linger in it.
+        self._where = None
+
+        # bumped whenever the rows are moved around, anything that remembers rows must check it
+        self.compactions = 0
+
+        if source is not None:
+            self.extend(source)
+
+    def _own(self, *names):
+        shared = self._shared
+
+        for name in names:
+            if name in shared:
+                setattr(self, name, getattr(self, name)[:])
+                shared.discard(name)
+
+    def writable(self, name):
+        # the column, for changing it in place
+        if name in self._shared:
+            self._own(name)
+
+        return getattr(self, name)
+
+    def isAlive(self, row):
+        return bool(self._alive[row])
+
+    @property
+    def rows(self):
+        # the rows of the notes, in order. Don't change it.
+        return self._rows
+
+    def compact(self):
+        # moves the rows into their positions and drops the removed ones
+        if self._compact:
+            return
+
+        rows = self._rows
+        alive = self._alive
+        views = self._views
+
+        for row, note in views.items():
+            if not alive[row]:
+                self._detach(note)
+                del views[row]
+
+        for name in COLUMNS:
+            col = getattr(self, name)
+            vals = map(col.__getitem__, rows)
+
+            if isinstance(col, array):
+                vals = array(col.typecode, vals)
+
+            setattr(self, name, vals)
+
+        if views:
+            where = array(b'i', [0]) * len(alive)
+
+            for pos, row in enumerate(rows):
+                where[row] = pos
+
+            self._views = dict((where[row], note) for row, note in views.items())
+
+            for row, note in self._views.items():
+                note._row = row
+
+        self._rows = array(b'i', xrange(len(rows)))
+        self._alive = array(b'b', [1]) * len(rows)
+        self._shared.clear()
+        self._compact = True
+        self._where = None
+        self.compactions += 1
+
+    def copy(self):
+        new = NoteArray()
+        self.compact()
+
+        shared = COLUMNS + ("_rows", "_alive")
+
+        for name in shared:
+            setattr(new, name, getattr(self, name))
+
+        new._shared.update(shared)
+        self._shared.update(shared)
+
+        # same rows, anything that remembers them for this array may use them for the copy too
+        new.compactions = self.compactions
+        return new
+
+    def extendColumns(self, band, hitTime, holdTime, ref, refOfs, isHint):
+        # appends notes straight from int sequences (isHint may be anything array('b') takes), skipping the views
+        first = len(self.hitTime)
+        count = len(hitTime)
+        self._own(*COLUMNS + ("_rows", "_alive"))
+
+        for name, vals in zip(COLUMNS, (band, hitTime, holdTime, ref, refOfs, isHint)):
+            if len(vals) != count:
+                raise ValueError("columns of different lengths")
+            getattr(self, name).extend(vals)
+
+        self.varBands.extend([None] * count)
+        self.refVarOfs.extend([None] * count)
+        self._alive.extend(array(b'b', [1]) * count)
+        self._rows.extend(array(b'i', xrange(first, first + count)))
+        self._where = None
+
+    def view(self, row):
+        note = self._views.get(row)
+
+        if note is None:
+            note = self._views[row] = Note.__new__(Note)
+            note._array = self
+            note._row = row
+            note.refObj = None
+
+        return note
+
+    def _position(self, i):
+        n = len(self._rows)
+
+        if i < 0:
+            i += n
+
+        if not 0 <= i < n:
+            raise IndexError("note index out of range")
+
+        return i
+
+    def _newRow(self, note):
+        src, i = note._array, note._row
+        row = len(self.hitTime)
+        varBands, refVarOfs = src.varBands[i], src.refVarOfs[i]
+
+        if self._shared:
+            self._own(*COLUMNS + ("_alive",))
+
+        # spelled out, this is how every note gets in
+        self.band.append(src.band[i])
+        self.hitTime.append(src.hitTime[i])
+        self.holdTime.append(src.holdTime[i])
+        self.ref.append(src.ref[i])
+        self.refOfs.append(src.refOfs[i])
+        self.isHint.append(src.isHint[i])
+        self._alive.append(1)
+
+        if isinstance(src, NoteRow):
+            note._array = self
+            note._row = row
+            self._views[row] = note
+        else:
+            # a copy of a note that's already in an array, don't share its lists
+            varBands = varBands if varBands is None else list(varBands)
+            refVarOfs = refVarOfs if refVarOfs is None else list(refVarOfs)
+
+        self.varBands.append(varBands)
+        self.refVarOfs.append(refVarOfs)
+        return row
+
+    def _detach(self, note):
+        row = NoteRow()
+
+        for name, val in zip(COLUMNS, note.values):
+            setattr(row, name, [val])
+
+        note._array = row
+        note._row = 0
+
+    def _removed(self):
+        # some rows were dropped from _rows
+        self._compact = False
+
+        if len(self.hitTime) - len(self._rows) > max(len(self._rows), 64):
+            self.compact()
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __iter__(self):
+        # like a list iterator: by position, so it sees notes appended while iterating, and _rows is looked up every
+        # time because _own() and compact() replace it
+        pos = 0
+
+        while pos < len(self._rows):
+            yield self.view(self._rows[pos])
+            pos += 1
+
+    def __contains__(self, note):
+        return isinstance(note, Note) and note._array is self and bool(self._alive[note._row])
+
+    def index(self, note, start=0, stop=None):
+        if note in self:
+            row = note._row
+
+            if self._compact:
+                pos = row
+            else:
+                if self._where is None:
+                    self._where = dict((r, p) for p, r in enumerate(self._rows))
+                pos = self._where[row]
+
+            if start <= pos and (stop is None or pos < stop):
+                return pos
+
+        raise ValueError("note not in NoteArray")
+
+    def __getitem__(self, i):
+        rows = self._rows
+
+        if isinstance(i, slice):
+            return [self.view(rows[pos]) for pos in xrange(*i.indices(len(rows)))]
+
+        return self.view(rows[self._position(i)])
+
+    def __setitem__(self, i, note):
+        if isinstance(i, slice):
+            notes = list(note)
+            start, stop, step = i.indices(len(self))
+
+            if step != 1:
+                raise ValueError("extended slice assignment is not supported")
+
+            del self[start:stop]
+            for ofs, note in enumerate(notes):
+                self.insert(start + ofs, note)
+            return
+
+        pos = self._position(i)
+        old = self._rows[pos]
+
+        if self._views.get(old) is note:
+            return
+
+        row = self._newRow(note)
+        self._own("_rows")
+        self._rows[pos] = row
+        self._alive[old] = 0
+
+        if self._where is not None:
+            self._where[row] = pos
+
+        self._removed()
+
+    def __delitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self))
+
+            if step != 1:
+                for pos in sorted(xrange(start, stop, step), reverse=True):
+                    del self[pos]
+                return
+        else:
+            start = self._position(i)
+            stop = start + 1
+
+        if start >= stop:
+            return
+
+        self._own("_rows", "_alive")
+
+        for row in self._rows[start:stop]:
+            self._alive[row] = 0
+
+        if stop < len(self._rows):
+            # the notes after them move
+            self._where = None
+
+        del self._rows[start:stop]
+        self._removed()
+
+    def insert(self, i, note):
+        n = len(self._rows)
+
+        if i < 0:
+            i = max(0, i + n)
+
+        row = self._newRow(note)
+        self._own("_rows")
+
+        if i >= n:
+            self._rows.append(row)
+
+            if self._where is not None:
+                self._where[row] = n
+        else:
+            self._rows.insert(i, row)
+            self._compact = False
+            self._where = None
+
+    def sort(self, key=None, reverse=False, keepRefs=False):
+        # sorts by hitTime by default (stable) and compacts. With keepRefs, refs keep pointing at the same notes.
+        if key is None:
+            key = self.hitTime.__getitem__
+        else:
+            key = (lambda k: lambda row: k(self.view(row)))(key)
+
+        rows = self._rows
+        order = array(b'i', sorted(rows, key=key, reverse=reverse))
+
+        unchanged = order == rows
+
+        if keepRefs and self.ref and ((not unchanged and max(self.ref) >= 0) or min(self.ref) < -1):
+            # refs are positions: old position -> row -> new position
+            newpos = [0] * len(self.hitTime)
+
+            for pos, row in enumerate(order):
+                newpos[row] = pos
+
+            where = [newpos[row] for row in rows]
+            ref = self.writable("ref")
+
+            for row in rows:
+                if ref[row] >= 0:
+                    ref[row] = where[ref[row]]
+                elif ref[row] < -1:
+                    ref[row] = -1
+
+        if unchanged:
+            # nothing to move (or copy)
+            self.compact()
+            return
+
+        self._rows = order
+        self._shared.discard("_rows")
+        self._compact = False
+        self.compact()
+
+    def __repr__(self):
+        return repr(list(self))
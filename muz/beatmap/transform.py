@@ -4,14 +4,40 @@ from __future__ import print_function
 from __future__ import division
 from __future__ import unicode_literals
 
-import random, logging
+import random, logging, weakref
 log = logging.getLogger(__name__)
 
 from . import Note
 
+def nondeterministic(func):
+    # marks a transform that may give a different result every time it's applied to the same beatmap, see Pipeline
+    func.deterministic = False
+    return func
+
+def isDeterministic(func, bmap):
+    # whether func would do the same thing to bmap every time
+    d = getattr(func, "deterministic", True)
+
+    if callable(d):
+        return d(bmap)
+
+    return d
+
+def hasVariableBands(bmap):
+    notes = bmap.notelist
+    varBands, refVarOfs = notes.varBands, notes.refVarOfs
+    return any(varBands[row] is not None or refVarOfs[row] is not None for row in notes.rows)
+
+# Transforms that run on every restart work on the columns where they can, so that a clone only copies
+# the columns that actually change and no views are made for notes nobody looks at.
+
 def shift(bmap, offset):
-    for note in bmap:
-        note.hitTime += offset
+    offset = int(offset)
+    hitTimes = bmap.notelist.writable("hitTime")
+
+    # removed rows too, they don't matter
+    for row in xrange(len(hitTimes)):
+        hitTimes[row] += offset
 
     return bmap
 
@@ -22,6 +48,8 @@ def scale(bmap, scale):
 
     return bmap
 
+# only makes every band variable, the random part is applyNondeterminism
+
 def randomize(bmap):
     applyRefs(bmap)
 
@@ -37,47 +65,66 @@ def applyNondeterminism(bmap):
     mindist = bmap.minimalNoteDistance
     busy = [0 for band in xrange(bmap.numbands)]
 
-    for notenum, note in enumerate(bmap):
-        if note.hitTime < 0:
+    # fix() leaves the notes compact: rows are positions
+    notes = bmap.notelist
+
+    for notenum in xrange(len(notes)):
+        hitTime = notes.hitTime[notenum]
+
+        if hitTime < 0:
             continue
 
-        if note.ref >= notenum:
-            raise RuntimeError("Reference to self or later note: %i -> %i" % (notenum, note.ref))
+        ref = notes.ref[notenum]
+
+        if ref >= notenum:
+            raise RuntimeError("Reference to self or later note: %i -> %i" % (notenum, ref))
+
+        if ref >= 0:
+            notes[notenum].resolveRef(bmap)
 
-        note.resolveRef(bmap)
+        band = notes.band[notenum]
+        varBands = notes.varBands[notenum]
 
-        if note.varBands is not None:
-            if note.varBands:
-                vb = note.varBands
+        if varBands is not None:
+            if varBands:
+                vb = varBands
             else:
                 vb = range(bmap.numbands)
 
             vb = [
-                band for band in [band % bmap.numbands for band in vb]
-                    if band in xrange(bmap.numbands) and note.hitTime - busy[band] >= 0
+                b for b in [b % bmap.numbands for b in vb]
+                    if b in xrange(bmap.numbands) and hitTime - busy[b] >= 0
             ]
 
             if vb:
-                note.band = random.choice(vb)
+                band = random.choice(vb)
 
-        if not note.isHint:
+        if not notes.isHint[notenum]:
             i = 1
-            oband = note.band
-            while note.hitTime - busy[note.band] < 0:
+            oband = band
+            while hitTime - busy[band] < 0:
                 if i > bmap.numbands * 2:
                     raise RuntimeError("No free bands, beatmap sucks")
 
                 if i == 1:
-                    log.warning("Note %i (%r) placed on a busy band, relocating", notenum, note)
+                    log.warning("Note %i (band %i at %i) placed on a busy band, relocating", notenum, band, hitTime)
 
-                note.band = (oband + i * (-1 + 2 * (i % 2))) % bmap.numbands
+                band = (oband + i * (-1 + 2 * (i % 2))) % bmap.numbands
                 i += 1
 
-        if note.holdTime >= 0:
-            busy[note.band] = max(busy[note.band], note.hitTime + note.holdTime + mindist)
+        if band != notes.band[notenum]:
+            notes.writable("band")[notenum] = band
+
+        holdTime = notes.holdTime[notenum]
+
+        if holdTime >= 0:
+            busy[band] = max(busy[band], hitTime + holdTime + mindist)
 
     return bmap
 
+# only random if there are bands to choose from
+applyNondeterminism.deterministic = lambda bmap: not hasVariableBands(bmap)
+
 def chainRefs(bmap, cOfs=0, vOfs=None):
     stripHints(bmap)
 
@@ -91,8 +138,12 @@ def chainRefs(bmap, cOfs=0, vOfs=None):
     return bmap
 
 def applyRefs(bmap):
-    for i, note in enumerate(bmap):
-        note.resolveRef(bmap)
+    notes = bmap.notelist
+    notes.compact()
+
+    for pos in xrange(len(notes)):
+        if notes.ref[pos] >= 0:
+            notes[pos].resolveRef(bmap)
 
     return bmap
 
@@ -110,11 +161,15 @@ def invalidateHints(bmap):
     return bmap
 
 def stripHints(bmap):
-    for note in tuple(bmap):
-        if note.isHint:
-            bmap.remove(note)
+    notes = bmap.notelist
+    notes.compact()
+
+    for pos in reversed([pos for pos, isHint in enumerate(notes.isHint) if isHint]):
+        del bmap[pos]
+
     return bmap
 
+@nondeterministic
 def insanify(bmap):
     bmap.fix()
 
@@ -180,11 +235,16 @@ def holdify(bmap):
     return bmap
 
 def orderBands(bmap, order):
-    for note in bmap:
-        note.band = order[note.band]
+    # removed rows could be on bands that don't exist anymore
+    bmap.notelist.compact()
+    bands = bmap.notelist.writable("band")
+
+    for row in xrange(len(bands)):
+        bands[row] = order[bands[row]]
 
     return bmap
 
+@nondeterministic
 def shuffleBands(bmap):
     o = range(bmap.numbands)
     random.shuffle(o)
@@ -195,7 +255,65 @@ def mirrorBands(bmap):
     orderBands(bmap, range(bmap.numbands)[::-1])
     return bmap
 
+def resizeBands(bmap, numbands):
+    bmap.numbands = numbands
+    return clampNotesToBands(bmap)
+
 def clampNotesToBands(bmap):
-    for note in bmap:
-        note.band %= bmap.numbands
+    notes = bmap.notelist
+
+    for row, band in enumerate(notes.band):
+        if band >= bmap.numbands:
+            notes.writable("band")[row] = band % bmap.numbands
+
     return bmap
+
+class Pipeline(object):
+    # A chain of transforms that is applied to clones of beatmaps. The result of the deterministic ones at the start
+    # is kept for every beatmap (which mustn't change afterwards), so applying it again only redoes the rest.
+
+    def __init__(self):
+        self.steps = []
+        self._prefixes = weakref.WeakKeyDictionary()
+
+    def add(self, func, *args):
+        self.steps.append((func, args))
+        self._prefixes.clear()
+        return self
+
+    def _prefix(self, bmap):
+        try:
+            return self._prefixes[bmap]
+        except KeyError:
+            pass
+
+        prefix = bmap.clone()
+        done = 0
+
+        for func, args in self.steps:
+            if not isDeterministic(func, prefix):
+                break
+
+            prefix.invalidateIndex()
+            func(prefix, *args)
+            done += 1
+
+        if done == len(self.steps):
+            # nothing left to change, the clones can share the index (cloning compacts, so do that first)
+            prefix.notelist.compact()
+            prefix.buildIndex()
+
+        log.debug("%i of %i transforms cached for %r", done, len(self.steps), bmap.name)
+        self._prefixes[bmap] = prefix, done
+        return prefix, done
+
+    def apply(self, bmap):
+        # returns a transformed clone, bmap is left alone
+        prefix, done = self._prefix(bmap)
+        bmap = prefix.clone()
+
+        for func, args in self.steps[done:]:
+            bmap.invalidateIndex()
+            func(bmap, *args)
+
+        return bmap
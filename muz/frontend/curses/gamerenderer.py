@@ -49,7 +49,7 @@ class GameRenderer(object):
         bandwidth = int(width / game.beatmap.numbands)
         holdwidth = bandwidth - 2
 
-        for note in game.beatmap:
+        for note in game.visibleNotes(targetoffs / noterate):
             hitdiff  = note.hitTime - game.time + targetoffs / noterate
             holddiff = hitdiff + note.holdTime
 
@@ -59,9 +59,6 @@ class GameRenderer(object):
             if hitdiff * noterate > height:
                 break
 
-            if note in game.removeNotes:
-                continue
-
             band = game.bands[note.band]
             vband = self.bands[note.band]
             o = clamp(ofsy, int(height - hitdiff * noterate), height)
@@ -298,7 +298,7 @@ class GameRenderer(object):
 
         maxNoteDist = float(bounds.height - self.targetoffs)
 
-        for note in game.beatmap:
+        for note in game.visibleNotes(self.targetoffs / noterate):
             hitdiff  = note.hitTime - game.time + self.targetoffs / noterate
             holddiff = hitdiff
 
@@ -311,9 +311,6 @@ class GameRenderer(object):
             if hitdiff * noterate > bounds.height + 5:
                 break
 
-            if note in game.removeNotes:
-                continue
-
             band = game.bands[note.band]
             vband = self.bands[note.band]
             bandoffs = vband.offset
@@ -342,7 +339,7 @@ class GameRenderer(object):
                 clr1 = self.notecolors[note.band]
                 clr2 = self.beamcolors[note.band]
 
-            if config["show-nearest-note"] and game.beatmap.nearest(note.band, game.time, muz.game.scoreinfo.miss.threshold) is note:
+            if config["show-nearest-note"] and game.beatmap.nearest(note.band, game.time, muz.game.scoreinfo.miss.threshold, skip=game.judgedNotes) is note:
                 clr1 = colors["nearest-note"]
                 clr2 = colors["nearest-note"]
 
@@ -12,6 +12,7 @@ import muz.assets
 import muz.game.scoreinfo
 
 from muz.util import clamp
+from muz.beatmap import transform
 from muz.game import config, log
 
 class Stats(object):
@@ -59,7 +60,13 @@ class Game(object):
         self.time = -1
         self.oldTime = self.time
         self.bands = [Band(band) for band in xrange(a.num_bands if a.num_bands > 0 else beatmap.numbands)]
-        self.removeNotes = []
+        self.transforms = None
+
+        # see resetNotes
+        self.judgedNotes = set()
+        self.activeNotes = collections.OrderedDict()
+        self.head = 0
+        self.visibleFrom = 0
 
         self.defaultNoterate = config["noterate"]
         self.maxNoterate = config["max-noterate"]
@@ -172,46 +179,88 @@ class Game(object):
     def resetScore(self):
         self.stats = Stats()
 
-    def reloadBeatmap(self):
-        self.beatmap = self.originalBeatmap.clone()
+    def buildTransforms(self):
+        a = muz.main.globalArgs
+        t = transform.Pipeline()
 
-        if len(self.bands) != self.beatmap.numbands:
-            self.beatmap.numbands = len(self.bands)
-            self.beatmap.clampNotesToBands()
+        if len(self.bands) != self.originalBeatmap.numbands:
+            t.add(transform.resizeBands, len(self.bands))
 
-        if muz.main.globalArgs.beatmap_offset is not None:
-            offs = muz.main.globalArgs.beatmap_offset
+        if a.beatmap_offset is not None:
+            offs = a.beatmap_offset
         else:
             offs = config["beatmap-offset"]
 
         if offs:
-            self.beatmap.shift(offs)
+            t.add(transform.shift, offs)
 
-        if config["no-holds"] or muz.main.globalArgs.no_holds:
-            self.beatmap.stripHolds()
+        if config["no-holds"] or a.no_holds:
+            t.add(transform.stripHolds)
 
-        if config["insane"] or muz.main.globalArgs.insane:
-            self.beatmap.insanify()
+        if config["insane"] or a.insane:
+            t.add(transform.insanify)
 
-        if config["randomize"] or muz.main.globalArgs.random:
-            self.beatmap.randomize()
+        if config["randomize"] or a.random:
+            t.add(transform.randomize)
 
-        if config["holdify"] or muz.main.globalArgs.holdify:
-            self.beatmap.holdify()
+        if config["holdify"] or a.holdify:
+            t.add(transform.holdify)
 
-        self.beatmap.applyNondeterminism()
-        self.beatmap.applyRefs()
+        t.add(transform.applyNondeterminism)
+        t.add(transform.applyRefs)
 
         if config["strip-hintnotes"]:
-            self.beatmap.stripHints()
+            t.add(transform.stripHints)
 
         # re-ordering goes very last, so that it doesn't break any refs
 
-        if config["shuffle-bands"] or muz.main.globalArgs.shuffle_bands:
-            self.beatmap.shuffleBands()
+        if config["shuffle-bands"] or a.shuffle_bands:
+            t.add(transform.shuffleBands)
+
+        if config['mirror-bands'] or a.mirror_bands:
+            t.add(transform.mirrorBands)
+
+        return t
+
+    def reloadBeatmap(self):
+        # only the random transforms are redone every time, see transform.Pipeline
+        if self.transforms is None:
+            self.transforms = self.buildTransforms()
+
+        self.beatmap = self.transforms.apply(self.originalBeatmap)
+        self.resetNotes()
+
+    def resetNotes(self):
+        # The notes stay in the beatmap while playing. The ones that reached the judgement line (head is the position
+        # of the next one) and haven't been judged yet are the active ones, in order. Judged notes are never looked
+        # at again, so the work per frame only depends on what's going on around the judgement line.
+        self.judgedNotes.clear()
+        self.activeNotes.clear()
+        self.head = 0
+        self.visibleFrom = 0
+
+    def visibleNotes(self, lead):
+        # For renderers: the notes that aren't judged yet and end no more than lead ms ago, in order.
+        # Notes that fell out of view are skipped for good.
+        notes = self.beatmap
+        judged = self.judgedNotes
+        i = self.visibleFrom
+
+        while i < len(notes):
+            note = notes[i]
+
+            if note not in judged and note.hitTime + max(0, note.holdTime) + lead >= self.time:
+                break
+
+            i += 1
+
+        self.visibleFrom = i
 
-        if config['mirror-bands'] or muz.main.globalArgs.mirror_bands:
-            self.beatmap.mirrorBands()
+        for i in xrange(i, len(notes)):
+            note = notes[i]
+
+            if note not in judged:
+                yield note
 
     def start(self, refreshBeatmap=True):
         if refreshBeatmap:
@@ -225,9 +274,6 @@ class Game(object):
         self.started = True
         self.paused = False
         self.finished = False
-        self.justStarted = True
-
-        del self.removeNotes[:]
 
     def resume(self):
         if not self.started:
@@ -279,7 +325,7 @@ class Game(object):
         if self.paused: return
         self.renderer.bandPressed(band.num)
 
-        note = self.beatmap.nearest(band.num, self.time, muz.game.scoreinfo.miss.threshold)
+        note = self.beatmap.nearest(band.num, self.time, muz.game.scoreinfo.miss.threshold, skip=self.judgedNotes)
 
         if note is None:
             return
@@ -312,8 +358,9 @@ class Game(object):
         self.renderer.displayScoreInfo(muz.game.scoreinfo.miss)
 
     def removeNote(self, note):
-        if note not in self.removeNotes:
-            self.removeNotes.append(note)
+        if note not in self.judgedNotes:
+            self.judgedNotes.add(note)
+            self.activeNotes.pop(note, None)
             band = self.bands[note.band]
             if band.heldNote == note:
                 self.registerRelease(band)
@@ -330,15 +377,25 @@ class Game(object):
         for s in self.soundplayed:
             self.soundplayed[s] = False
 
-        for note in self.removeNotes:
-            try:
-                self.beatmap.remove(note)
-            except Exception: # wtf?
-                log.debug("removing a note failed, wtf?", exc_info=True)
-        del self.removeNotes[:]
+        notes = self.beatmap
+        active = self.activeNotes
+        judged = self.judgedNotes
+
+        # let in the notes that reached the judgement line
+        while self.head < len(notes):
+            note = notes[self.head]
+
+            if note.hitTime > self.time:
+                break
+
+            if not note.isHint and note not in judged:
+                active[note] = True
+
+            self.head += 1
 
-        for note in self.beatmap:
-            if note.isHint:
+        for note in active.keys():
+            if note not in active:
+                # judged while handling an earlier one
                 continue
 
             d = note.hitTime + note.holdTime - self.time
@@ -352,10 +409,10 @@ class Game(object):
                 if d <= 0 and self.bands[note.band].heldNote is note:
                     self.registerRelease(self.bands[note.band])
 
-            if d - note.holdTime > 0:
-                break
+            if d - note.holdTime > 0 or note not in active:
+                continue
 
-            if d < -muz.game.scoreinfo.bad.threshold or (d < 0 and note is not self.beatmap.nearest(note.band, self.time, muz.game.scoreinfo.miss.threshold)):
+            if d < -muz.game.scoreinfo.bad.threshold or (d < 0 and note is not notes.nearest(note.band, self.time, muz.game.scoreinfo.miss.threshold, skip=judged)):
             #if d < -muz.game.scoreinfo.miss.threshold:
                 self.registerMiss(note, abs(d))
 
@@ -411,10 +468,6 @@ class Game(object):
 
         self.oldTime = self.time
 
-        if self.justStarted:
-            del self.removeNotes[:]
-            self.justStarted = False
-
     def update(self):
         dt = self.clock.deltaTime
         if self.aggressiveUpdate:
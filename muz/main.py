@@ -7,7 +7,6 @@ from __future__ import division
 from __future__ import unicode_literals
 
 import os, sys, logging, argparse
-from itertools import ifilter as filter
 
 import muz
 import muz.frontend
@@ -23,6 +22,7 @@ VERSION = "0.01-prepreprealpha"
 
 basedir = os.path.abspath(os.path.join(os.path.dirname(__file__), 'data'))
 userdir = os.path.abspath(os.path.join(os.path.expanduser("~"), ".muz"))
+cachedir = os.path.join(userdir, "cache")
 globalArgs = None
 frontend = None
 log = logging.getLogger(__name__)
@@ -38,6 +38,11 @@ def initvfs():
         return
 
     vfs.applySettings()
+    vfs.index.open(os.path.join(userdir, "vfs.index"))
+    vfs.ignoredPaths.add(cachedir)
+    vfs.extractionCache.open(os.path.join(cachedir, "extracted"))
+    beatmap.beatmapCache.open(os.path.join(cachedir, "beatmaps"))
+    beatmap.beatmapLibrary.open(os.path.join(cachedir, "library.sqlite"))
 
     def initroot(root=vfs.root):
         root.loadDataDirs(basedir, userdir, *globalArgs.extradirs)
@@ -60,7 +65,7 @@ def initArgParser(desc=None, prog=None):
     return argparse.ArgumentParser(description=desc, prog=prog, add_help=False, conflict_handler='resolve')
 
 def handleGeneralArgs(parser, argv, namespace):
-    global globalArgs, userdir, basedir
+    global globalArgs, userdir, basedir, cachedir
 
     g = parser.add_argument_group(title="general options")
     g.add_argument('--basedir', action='store', default=basedir,
@@ -82,11 +87,17 @@ def handleGeneralArgs(parser, argv, namespace):
                    help="load an alternative configuration file (default: $userdir/config.json)")
     
     g.add_argument('-l', '--list-beatmaps', dest="listbeatmaps", action="count", default=False,
-                   help="list all beatmaps found in the virtual filesystem, specify twice to also list their 'nicer' names parsed from metadata (slow)")
+                   help="list all beatmaps found in the virtual filesystem, specify twice to also list their 'nicer' names parsed from metadata (served from the beatmap library, only new or changed beatmaps are parsed)")
+
+    g.add_argument('-s', '--search', metavar="QUERY", action="store", default=None,
+                   help="list the beatmaps whose name, title, artist, variant or author contain every word of the query and exit")
 
     g.add_argument('-L', '--list-vfs', dest="listvfspath", metavar="PATH", action="store", nargs='?', const='', default=None,
                    help="list the contents of a path in the virtual filesystem and exit")
 
+    g.add_argument('--beatmap-cache-stats', dest="beatmapcachestats", action="store_true", default=False,
+                   help="print statistics about the parsed beatmap cache and exit")
+
     g.add_argument('--log-level', dest="loglevel", metavar="LEVEL", choices=["critical", "error", "warning", "info", "debug"], default=None,
                    help="set the output verbosity level, overrides the config setting (default: warning)")
 
@@ -104,6 +115,7 @@ def handleGeneralArgs(parser, argv, namespace):
     globalArgs = n
     basedir = os.path.abspath(n.basedir)
     userdir = os.path.abspath(n.userdir)
+    cachedir = os.path.join(userdir, "cache")
 
     if globalArgs.loglevel is not None:
         muz.log.setLevel(muz.util.logLevelByName(globalArgs.loglevel))
@@ -117,22 +129,38 @@ def handleGeneralArgs(parser, argv, namespace):
 
         exit(0)
 
-    if n.listbeatmaps:
+    if n.beatmapcachestats:
         init()
-        def getname(s):
-            if n.listbeatmaps < 2:
-                return s
-
-            try:
-                b = muz.beatmap.load(s, bare=True)
-            except Exception as e:
-                log.exception("failed to load beatmap %s: %s", s, e)
-                return s
-            else:
-                return "%s: %s" %(s, b.name)
 
-        for s in sorted(filter(None, (muz.beatmap.nameFromPath(path+obj) for path, obj, _ in vfs.root.walk()))):
-            print(getname(s))
+        stats = beatmap.beatmapCache.stats()
+        for key in sorted(stats):
+            print("%s: %s" % (key, stats[key]))
+
+        exit(0)
+
+    if n.listbeatmaps or n.search is not None:
+        init()
+
+        if n.listbeatmaps < 2 and n.search is None:
+            for s in sorted(set(muz.beatmap.listNames())):
+                print(s)
+
+            exit(0)
+
+        lib = beatmap.beatmapLibrary
+        lib.refresh()
+
+        printed = set()
+        for row in (lib.list() if n.search is None else lib.search(n.search)):
+            if row["name"] in printed:
+                continue
+
+            printed.add(row["name"])
+
+            if row["title"]:
+                print("%s: %s" % (row["name"], row["title"]))
+            else:
+                print(row["name"])
 
         exit(0)
 
@@ -4,7 +4,7 @@ from __future__ import print_function
 from __future__ import division
 from __future__ import unicode_literals
 
-import string, logging, sys, os
+import string, logging, sys, os, codecs, re, json
 from functools import wraps
 
 import muz
@@ -127,6 +127,219 @@ def forever(func):
             func(*args, **kwargs)
     return wrapper
 
+def iterLines(fobj, encoding=None, chunkSize=64 * 1024):
+    # Yields the non-empty lines of a binary file, decoded if an encoding is given.
+    # Both \r and \n count as line terminators.
+    if encoding is None:
+        decode = None
+        cr, lf, tail = b"\r", b"\n", b""
+    else:
+        decode = codecs.getincrementaldecoder(encoding)().decode
+        cr, lf, tail = "\r", "\n", ""
+
+    while True:
+        raw = fobj.read(chunkSize)
+        chunk = raw if decode is None else decode(raw, not raw)
+
+        if chunk:
+            lines = (tail + chunk).replace(cr, lf).split(lf)
+            tail = lines.pop()
+
+            for line in lines:
+                if line:
+                    yield line
+
+        if not raw:
+            break
+
+    if tail:
+        yield tail
+
+class JSONScanner(object):
+    # Finds where JSON values begin and end in a binary file, reading it in chunks as it goes.
+    # Nothing is parsed; the structural characters are all ascii, so this works on raw utf-8.
+
+    whitespace = b" \t\r\n"
+    string = br'"[^"\\]*(?:\\.[^"\\]*)*"'
+    other = br'[^"\[\]{}]'
+
+    stringEnd = re.compile(string)
+    scalarEnd = re.compile(br'[,}\]\s]')
+
+    # strings, brackets-free text and whole flat objects/arrays (like the notes of most formats), in one go
+    skippable = re.compile(br'(?:%(s)s|%(o)s+|\{%(o)s*(?:%(s)s%(o)s*)*\}|\[%(o)s*(?:%(s)s%(o)s*)*\])*' % {
+        b"s": string, b"o": other,
+    })
+
+    def __init__(self, fobj, chunkSize):
+        self.fobj = fobj
+        self.chunkSize = chunkSize
+        self.buf = b""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        if self.eof:
+            return False
+
+        # reading at least as much as is buffered keeps long values from getting copied over and over
+        data = self.fobj.read(max(self.chunkSize, len(self.buf)))
+
+        if not data:
+            self.eof = True
+            return False
+
+        self.buf += data
+        return True
+
+    def drop(self, pos):
+        # forgets everything before pos, returns pos relative to the new start of the buffer
+        self.buf = self.buf[pos:]
+        self.pos = 0
+        return 0
+
+    def skipSpace(self):
+        # returns the next non-whitespace character, or an empty string at EOF
+        while True:
+            buf, pos = self.buf, self.pos
+
+            while pos < len(buf) and buf[pos:pos + 1] in self.whitespace:
+                pos += 1
+
+            self.pos = pos
+
+            if pos < len(buf) or not self.fill():
+                return buf[pos:pos + 1]
+
+    def skipString(self, pos):
+        while True:
+            m = self.stringEnd.match(self.buf, pos)
+
+            if m is not None:
+                return m.end()
+
+            if not self.fill():
+                raise ValueError("unterminated JSON string")
+
+    def skipContainer(self, pos, keep):
+        # pos is at the opening bracket
+        depth = 1
+        pos += 1
+
+        while True:
+            pos = self.skippable.match(self.buf, pos).end()
+            c = self.buf[pos:pos + 1]
+
+            if not c or c == b'"':
+                # out of data, possibly in the middle of a string
+                if not keep:
+                    pos = self.drop(pos)
+
+                if not self.fill():
+                    raise ValueError("unterminated JSON container")
+
+                continue
+
+            depth += 1 if c in b"[{" else -1
+            pos += 1
+
+            if not depth:
+                return pos
+
+    def skipScalar(self, pos):
+        while True:
+            m = self.scalarEnd.search(self.buf, pos)
+
+            if m is not None:
+                return m.start()
+
+            if not self.fill():
+                return len(self.buf)
+
+def iterJSONMembers(fobj, chunkSize=4096, keys=None):
+    # Yields (key, raw value) for the members of the top-level object of a JSON file, reading no further than the
+    # caller iterates. Values aren't parsed; json.loads the ones you need. If keys is given, the values of other
+    # members aren't kept either (they're yielded as None), so skipping over big ones is cheap.
+    # Anything before the first { is ignored.
+    s = JSONScanner(fobj, chunkSize)
+
+    while True:
+        i = s.buf.find(b"{", s.pos)
+
+        if i >= 0:
+            s.pos = i + 1
+            break
+
+        s.pos = len(s.buf)
+        if not s.fill():
+            return
+
+    while True:
+        s.drop(s.pos)
+        c = s.skipSpace()
+
+        if not c or c == b"}":
+            return
+
+        if c == b",":
+            s.pos += 1
+            continue
+
+        if c != b'"':
+            raise ValueError("malformed JSON object")
+
+        end = s.skipString(s.pos)
+        key = json.loads(s.buf[s.pos:end].decode('utf-8'))
+        s.pos = end
+
+        if s.skipSpace() != b":":
+            raise ValueError("malformed JSON object")
+
+        s.pos += 1
+        c = s.skipSpace()
+        start = s.pos
+        keep = keys is None or key in keys
+
+        if c == b'"':
+            end = s.skipString(start)
+        elif c and c in b"[{":
+            end = s.skipContainer(start, keep)
+        else:
+            end = s.skipScalar(start)
+
+        s.pos = end
+        yield key, s.buf[start:end] if keep else None
+
+def evictLRU(path, limit, keep=()):
+    # Removes the least recently modified files in path until their total size fits into limit (in bytes).
+    # Paths in keep are never removed. Returns the resulting total size.
+    entries = []
+    total = 0
+
+    for f in os.listdir(path):
+        fpath = os.path.join(path, f)
+        st = os.stat(fpath)
+        entries.append((st.st_mtime, st.st_size, fpath))
+        total += st.st_size
+
+    for mtime, size, fpath in sorted(entries):
+        if total <= limit:
+            break
+
+        if fpath in keep:
+            continue
+
+        try:
+            os.remove(fpath)
+        except OSError:
+            # probably still in use by another instance
+            log.debug("couldn't evict %s", fpath, exc_info=True)
+        else:
+            log.info("evicted %s", fpath)
+            total -= size
+
+    return total
+
 def multiset(objs, **attrs):
     for obj in objs:
         for attr in attrs:
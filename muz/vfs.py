@@ -4,9 +4,12 @@ from __future__ import print_function
 from __future__ import division
 from __future__ import unicode_literals
 
-import os, zipfile, tempfile, shutil, atexit, logging, shutil, collections
+import os, io, stat, fnmatch, zipfile, tempfile, shutil, atexit, logging, shutil, collections, hashlib, mmap, struct, time, zlib, weakref
+from multiprocessing.pool import ThreadPool
+import cPickle as pickle
 
 import muz
+import muz.util
 import muz.config
 
 from muz.util import multiset
@@ -16,6 +19,13 @@ config = muz.config.get(__name__, {
     "load-packs"        : True,
     "try-local"         : True,
     "auto-convert-mp3"  : False,
+    "use-index"         : True,
+    "extract-cache-size": 256,
+    "mmap-stored"       : True,
+    "pack-loading-threads": 0,
+    "pack-compression-level": 6,
+    "pack-store-extensions": ["ogg", "mp3", "opus", "flac", "png", "jpg", "jpeg", "zip", "pk3", "osz"],
+    "pack-store-alignment": 4,
 })
 
 VPATH_SELF = '.'
@@ -25,6 +35,18 @@ VPATH_SEP = '/'
 
 tempfiles = []
 
+# ZipArchives holding an open zip or mapping (by id, they're unhashable), closed at exit
+openArchives = weakref.WeakValueDictionary()
+
+# real paths that are never scanned into the vfs (e.g. cache directories inside the userdir)
+ignoredPaths = set()
+
+# bumped whenever the tree is modified, invalidates memoized path resolutions
+generation = 0
+
+# real path -> RealFile node attached to the tree, used to trace other RealFile objects for the same file
+realFiles = {}
+
 log = logging.getLogger(__name__)
 
 def iterPath(vpath):
@@ -44,12 +66,19 @@ def normalizePath(vpath):
 
     return VPATH_SEP.join(sublist)
 
+def joinPath(*parts):
+    return VPATH_SEP.join(p for p in parts if p)
+
 def dirname(vpath):
     p = tuple(iterPath(vpath))
     if len(p) > 1:
         return p[-2]
     return ""
 
+def invalidate():
+    global generation
+    generation += 1
+
 def packNameValid(packpath):
     return any(packpath.endswith("." + e) for e in ("pk3dir", "pk3", "zip", "osz"))
 
@@ -73,6 +102,227 @@ def loadPack(packpath):
 
     raise RuntimeError("invalid pack name %s" % packpath)
 
+def openPacks(packpaths):
+    threads = min(config["pack-loading-threads"], len(packpaths))
+
+    if threads < 2:
+        return [loadPack(packpath) for packpath in packpaths]
+
+    def load(packpath):
+        pack, subdir = loadPack(packpath)
+        return pack.force(), subdir
+
+    # only the reading is done in parallel, the results are merged by the caller in the original order
+    pool = ThreadPool(threads)
+
+    try:
+        return pool.map(load, packpaths)
+    finally:
+        pool.close()
+        pool.join()
+
+def stamp(path):
+    st = os.stat(path)
+    return st.st_size, st.st_mtime
+
+class Index(object):
+    # bump this whenever the layout of the stored tables changes
+    version = 2
+
+    def __init__(self):
+        self.path = None
+        self.dirs = {}
+        self.packs = {}
+        self.dirty = False
+
+    def open(self, path):
+        self.path = path
+        self.dirs = {}
+        self.packs = {}
+        self.dirty = False
+
+        if not config["use-index"]:
+            return
+
+        try:
+            with open(path, 'rb') as f:
+                version, dirs, packs = pickle.load(f)
+        except IOError:
+            log.info("vfs index %s doesn't exist yet", path)
+            return
+        except Exception:
+            log.warning("vfs index %s is corrupted, rebuilding", path)
+            log.debug("dumping traceback", exc_info=True)
+            return
+
+        if version != self.version:
+            log.info("vfs index %s is outdated, rebuilding", path)
+            return
+
+        self.dirs = dirs
+        self.packs = packs
+        log.info("loaded vfs index %s (%i directories, %i packs)", path, len(dirs), len(packs))
+
+    def save(self):
+        if self.path is None or not self.dirty or not config["use-index"]:
+            return
+
+        for table in self.dirs, self.packs:
+            for path in [p for p in table if not os.path.exists(p)]:
+                del table[path]
+
+        # overwritten in place: renaming a temporary file over it would bump the mtime of the
+        # directory it's in, which is usually the userdir, and invalidate its own entry every run
+        try:
+            with open(self.path, 'wb') as f:
+                pickle.dump((self.version, self.dirs, self.packs), f, pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            log.exception("couldn't save the vfs index %s", self.path)
+        else:
+            log.info("saved vfs index %s", self.path)
+            self.dirty = False
+
+    def get(self, table, path, builder):
+        if not config["use-index"]:
+            return builder()
+
+        try:
+            st = stamp(path)
+        except OSError:
+            return builder()
+
+        entry = table.get(path)
+        if entry is not None and entry[0] == st:
+            return entry[1]
+
+        data = builder()
+        table[path] = (st, data)
+        self.dirty = True
+        return data
+
+    def listDir(self, path):
+        return self.get(self.dirs, path, lambda: [
+            (f, os.path.isdir(os.path.join(path, f))) for f in sorted(os.listdir(path))
+        ])
+
+    def listPack(self, path, zip):
+        return self.get(self.packs, path, lambda: zip().infolist())
+
+index = Index()
+
+class DirectoryCache(object):
+    # In-memory cache of real directory listings and the stats of their entries.
+    # A listing is reused for as long as the directory's mtime stays the same.
+
+    def __init__(self):
+        self.entries = {}
+
+    def clear(self):
+        self.entries.clear()
+
+    def get(self, path):
+        mtime = os.stat(path).st_mtime
+        entry = self.entries.get(path)
+
+        if entry is None or entry[0] != mtime:
+            names = sorted(os.listdir(path))
+            entry = (mtime, names, frozenset(names), {})
+            self.entries[path] = entry
+
+        return entry
+
+    def listDir(self, path):
+        return self.get(path)[1]
+
+    def contains(self, path, name):
+        return name in self.get(path)[2]
+
+    def stat(self, path):
+        dpath, name = os.path.split(os.path.abspath(path))
+        mtime, names, nameset, stats = self.get(dpath)
+
+        if name not in nameset:
+            raise OSError(2, "No such file or directory", path)
+
+        st = stats.get(name)
+
+        if st is None:
+            st = stats[name] = os.stat(path)
+
+        return st
+
+    def isFile(self, path):
+        try:
+            return stat.S_ISREG(self.stat(path).st_mode)
+        except OSError:
+            return False
+
+dirCache = DirectoryCache()
+
+class ExtractionCache(object):
+    def __init__(self):
+        self.path = None
+
+        # every path handed out is kept until exit, whoever got it (e.g. a game playing the music) may still need it
+        self.pinned = set()
+
+    def open(self, path):
+        self.path = path
+        self.pinned = set()
+
+        # the pins may have let the cache outgrow its limit last time
+        if self.enabled and os.path.isdir(path):
+            self.evict()
+
+    @property
+    def enabled(self):
+        return self.path is not None and config["extract-cache-size"] > 0
+
+    def key(self, node):
+        info = node.info
+        h = hashlib.sha1()
+
+        for part in node.zipPath, info.filename:
+            if isinstance(part, unicode):
+                part = part.encode('utf-8')
+            h.update(part + b"\0")
+
+        h.update(b"%08x:%i" % (info.CRC & 0xffffffff, info.file_size))
+        return h.hexdigest() + os.path.splitext(info.filename)[-1]
+
+    def get(self, node):
+        fpath = os.path.join(self.path, self.key(node))
+
+        self.pinned.add(fpath)
+
+        if os.path.exists(fpath):
+            # the mtime doubles as the last access time for eviction
+            os.utime(fpath, None)
+            return fpath
+
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+        tmp = "%s.%i.tmp" % (fpath, os.getpid())
+
+        with node.open() as src, open(tmp, 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+
+        try:
+            os.rename(tmp, fpath)
+        except OSError:
+            # another instance got there first (windows won't rename over an existing file)
+            os.remove(tmp)
+
+        log.info("extracted %s from %s to %s", node.name, node.zipPath, fpath)
+        self.evict()
+        return fpath
+
+    def evict(self):
+        muz.util.evictLRU(self.path, config["extract-cache-size"] * 1024 * 1024, keep=self.pinned)
+
+extractionCache = ExtractionCache()
+
 class VFSError(Exception):
     pass
 
@@ -83,10 +333,17 @@ class NodeNotFoundError(VFSError):
     pass
 
 class Node(object):
+    # see LazyNode
+    forced = True
+
     def __init__(self, *args, **kwargs):
         self._temp = None
         self.realPathExists = False
         self.isDir = False
+
+        # the key this node is stored under in its parent, set when it's attached to a directory
+        self.vname = None
+
         super(Node, self).__init__(*args, **kwargs)
 
     # Can't I do it better somehow?
@@ -95,6 +352,9 @@ class Node(object):
         if not isinstance(vpath, unicode):
             vpath = vpath.decode('utf-8')
 
+        if createDirs or put is not None:
+            invalidate()
+
         o = None
         f = self
 
@@ -125,6 +385,8 @@ class Node(object):
         return f
 
     def merge(self, n):
+        invalidate()
+
         for key in n:
             if key in VPATH_SPECIAL:
                 continue
@@ -201,38 +463,80 @@ class Node(object):
             log.debug("alternative for %s doesn't exist", self.name, exc_info=True)
             return self
 
-    def walk(self, pref=''):
-        for key, val in self.items():
-            if key not in VPATH_SPECIAL:
-                try:
-                    for d, f, v in val.walk(pref + key + VPATH_SEP):
-                        yield d, f, v
-                except Exception:
-                    yield pref, key, val
+    def force(self):
+        return self
+
+    def walk(self, pref='', pattern=None, exts=None, force=True):
+        # pattern is matched component by component (so * never crosses a /), and only directories
+        # that can still match it are entered. Unbuilt lazy nodes are skipped entirely if not force.
+        parts = None if pattern is None else tuple(iterPath(pattern))
+
+        if exts is not None:
+            exts = frozenset(exts)
+
+        stack = [(pref, self, 0)]
+
+        while stack:
+            dpref, d, depth = stack.pop()
+
+            for key, val in d.items():
+                if key in VPATH_SPECIAL:
+                    continue
+
+                if parts is not None and (depth >= len(parts) or not fnmatch.fnmatchcase(key, parts[depth])):
+                    continue
+
+                if not force and not val.forced:
+                    continue
+
+                if val.isDir:
+                    if parts is None or depth + 1 < len(parts):
+                        stack.append((dpref + key + VPATH_SEP, val, depth + 1))
+                elif parts is not None and depth + 1 < len(parts):
+                    continue
+                elif exts is None or key.rpartition('.')[2] in exts:
+                    yield dpref, key, val
 
     def trace(self, node, myname='.'):
-        if self is node or node.realPathExists and self.realPathExists and self.realPath == node.realPath:
-            return myname
+        path = self.pathTo(node)
 
-        path = [myname]
+        if path is None and node.realPathExists:
+            twin = realFiles.get(node.realPath)
 
-        try:
-            for k, n in self.items():
-                if k not in VPATH_SPECIAL:
-                    p = n.trace(node, myname=k)
-                    if p:
-                        path.append(p)
-                        return VPATH_SEP.join(path)
-        except Exception:
+            if twin is not None:
+                path = self.pathTo(twin)
+
+        if path is None:
             return None
 
-        return None
+        return VPATH_SEP.join([myname] + path)
+
+    def pathTo(self, node):
+        # follows the parent links up from node, so that no other parts of the tree have to be visited (or forced)
+        path = []
+
+        while node is not self:
+            parent = node.parent
+
+            if parent is node or node.vname is None:
+                return None
+
+            path.append(node.vname)
+            node = parent
+
+        path.reverse()
+        return path
 
     @property
     def realPath(self):
         with self.tempFile() as f:
             return f.name
 
+    @property
+    def fingerprint(self):
+        # something that changes whenever the contents of the node do, or None if that can't be told cheaply
+        return None
+
 class LazyNode(object):
     def __init__(self, builder, parent=None):
         self._builder = builder
@@ -242,6 +546,15 @@ class LazyNode(object):
             parent = self
 
         self.parent = parent
+        self.vname = None
+
+    def __setattr__(self, attr, value):
+        super(LazyNode, self).__setattr__(attr, value)
+
+        # keep the tree links of an already built node in sync with the wrapper
+        node = self.__dict__.get("_node")
+        if node is not None and attr in ("parent", "vname"):
+            setattr(node, attr, node if value is self else value)
 
     @property
     def node(self):
@@ -254,16 +567,27 @@ class LazyNode(object):
             else:
                 n.parent = self.parent
 
+            n.vname = self.vname
             self._node = n
 
         return self._node
 
+    def force(self):
+        return self.node
+
+    @property
+    def forced(self):
+        return self._node is not None
+
     def __getattr__(self, attr):
         return getattr(self.node, attr)
 
     def __iter__(self):
         return self.node.__iter__()
 
+    def __contains__(self, i):
+        return i in self.node
+
     def __setitem__(self, i, v):
         self.node[i] = v
 
@@ -316,6 +640,10 @@ class RealFile(Node):
     def realPath(self):
         return self._realPath
 
+    @property
+    def fingerprint(self):
+        return (self._realPath,) + stamp(self._realPath)
+
     def open(self, mode='rb'):
         log.info("opening file %s with mode %s", self._realPath, repr(mode))
         return open(self._realPath, mode)
@@ -333,16 +661,18 @@ class RealFile(Node):
             return self.parent
 
         p = os.path.join(self._realPath, key)
-        if not os.path.exists(p):
+        if not dirCache.contains(self._realPath, key):
             raise RuntimeError("%s: no such file or directory" % p)
 
-        return RealFile(p, self)
+        n = RealFile(p, self)
+        n.vname = key
+        return n
 
     def __contains__(self, key):
-        return key in VPATH_SPECIAL or key in os.listdir(self._realPath + os.path.sep)
+        return key in VPATH_SPECIAL or dirCache.contains(self._realPath, key)
 
     def __iter__(self):
-        for f in sorted(os.listdir(self._realPath)):
+        for f in dirCache.listDir(self._realPath):
             yield f
 
     def __repr__(self):
@@ -364,25 +694,27 @@ class VirtualDirectory(Node, collections.MutableMapping):
         if not config["load-packs"]:
             loadPacks = False
 
+        entries = index.listDir(path)
+
         # load packs before loose files, so that we can always override a pack's contents with files
         if loadPacks:
-            for f in sorted(os.listdir(path)):
-                fpath = os.path.join(path, f)
+            packpaths = [os.path.join(path, f) for f, isdir in entries if packNameValid(f)]
 
-                if packNameValid(fpath):
-                    vd.loadPack(fpath)
+            for pack, subdir in openPacks(packpaths):
+                vd.mergePack(pack, subdir)
 
-        for f in os.listdir(path):
+        for f, isdir in entries:
             fpath = os.path.join(path, f).decode('utf-8')
 
-            if loadPacks and packNameValid(fpath):
+            if loadPacks and packNameValid(fpath) or fpath in ignoredPaths:
                 continue
 
-            if recursive and os.path.isdir(fpath):
+            if recursive and isdir:
                 o = LazyNode(parent=vd, builder=lambda fpath=fpath: cls.fromFileSystem(fpath, loadPacks=loadPacks,
                                                                                               recursive=recursive))
             else:
                 o = RealFile(fpath)
+                realFiles[o.realPath] = o
 
             if f in vd:
                 vd[f].merge(o)
@@ -395,12 +727,17 @@ class VirtualDirectory(Node, collections.MutableMapping):
 
     def loadPack(self, packpath):
         pack, subdir = loadPack(packpath)
+        return self.mergePack(pack, subdir)
+
+    def mergePack(self, pack, subdir):
         self.locate(subdir, createDirs=True).merge(pack)
+        invalidate()
         return pack, subdir
 
     def loadDataDirs(self, *paths):
         for path in paths:
             self.merge(VirtualDirectory.fromFileSystem(os.path.abspath(path)))
+        invalidate()
 
     def __delitem__(self, i):
         del self.dict[i]
@@ -419,6 +756,7 @@ class VirtualDirectory(Node, collections.MutableMapping):
             raise KeyError("Attempted to overwrite a reserved node %r", v)
 
         self.dict[i] = v
+        v.vname = i
 
     def __iter__(self):
         return iter(self.dict)
@@ -433,20 +771,58 @@ class RootDirectory(VirtualDirectory):
     def __init__(self, *args, **kwargs):
         super(RootDirectory, self).__init__(*args, **kwargs)
         self.name = "<root>"
+        self.resolved = {}
+        self.resolvedGeneration = generation
 
     def locate(self, vpath, *args, **kwargs):
-        tryLocal = config["try-local"]
+        if args or kwargs:
+            return self.resolve(vpath, *args, **kwargs)
+
+        if not isinstance(vpath, unicode):
+            vpath = vpath.decode('utf-8')
 
+        if self.resolvedGeneration != generation:
+            self.resolved.clear()
+            self.resolvedGeneration = generation
+
+        # only the virtual lookup is memoized, the real filesystem can change without the generation noticing
+        try:
+            node = self.resolved[vpath]
+        except KeyError:
+            node = self.resolveVirtual(vpath)
+
+            # resolveVirtual() may have modified the tree (e.g. by forcing lazy nodes that merge stuff)
+            if self.resolvedGeneration == generation:
+                self.resolved[vpath] = node
+        else:
+            if node is None:
+                log.debug("object %s not found in the virtual filesystem (cached)", vpath)
+
+        if node is None:
+            node = self.resolveReal(vpath)
+
+        return node
+
+    def resolve(self, vpath, *args, **kwargs):
+        node = self.resolveVirtual(vpath, *args, **kwargs)
+
+        if node is None:
+            node = self.resolveReal(vpath)
+
+        return node
+
+    def resolveVirtual(self, vpath, *args, **kwargs):
         try:
             return super(RootDirectory, self).locate(vpath, *args, **kwargs)
         except Exception:
             log.warning("object %s not found in the virtual filesystem%s", vpath,
-                        ", interpreting as a real path" if tryLocal else "")
+                        ", interpreting as a real path" if config["try-local"] else "")
             log.debug("dumping traceback", exc_info=True)
 
-        if tryLocal:
+    def resolveReal(self, vpath):
+        if config["try-local"]:
             try:
-                assert os.path.isfile(vpath)
+                assert dirCache.isFile(vpath)
                 assert os.access(vpath, os.R_OK)
                 return RealFile(vpath)
             except Exception:
@@ -455,50 +831,296 @@ class RootDirectory(VirtualDirectory):
 
         raise RuntimeError("object %s couldn't be located" % vpath)
 
+class MappedFile(io.RawIOBase):
+    # Read-only file-like view of a region of a memory-mapped file.
+
+    def __init__(self, mm, offset, size, name):
+        super(MappedFile, self).__init__()
+        self.mm = mm
+        self.start = offset
+        self.end = offset + size
+        self.pos = offset
+        self.name = name
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def read(self, n=-1):
+        if n is None or n < 0:
+            n = self.end - self.pos
+        else:
+            n = min(n, self.end - self.pos)
+
+        data = self.mm[self.pos:self.pos + n]
+        self.pos += len(data)
+        return data
+
+    def readall(self):
+        return self.read()
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        n = len(data)
+        b[:n] = data
+        return n
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            pos = self.start + offset
+        elif whence == io.SEEK_CUR:
+            pos = self.pos + offset
+        elif whence == io.SEEK_END:
+            pos = self.end + offset
+        else:
+            raise ValueError("invalid whence (%r)" % whence)
+
+        self.pos = max(self.start, min(pos, self.end))
+        return self.pos - self.start
+
+    def tell(self):
+        return self.pos - self.start
+
+    def __repr__(self):
+        return "MappedFile(%s, %i, %i)" % (repr(self.name), self.start, self.end - self.start)
+
 class ZipArchiveFile(Node):
-    def __init__(self, base, name):
+    def __init__(self, base, info):
         super(ZipArchiveFile, self).__init__()
 
-        self.name = name
-        self.zip = base.zip
+        self.name = info.filename
+        self.info = info
+        self.archive = base
         self.zipPath = base.zipPath
 
+    @property
+    def zip(self):
+        return self.archive.zip
+
+    @property
+    def mapped(self):
+        # stored (uncompressed, unencrypted) members can be read straight from a mapping of the archive
+        info = self.info
+        return config["mmap-stored"] and info.compress_type == zipfile.ZIP_STORED and not info.flag_bits & 0x1
+
     def open(self, mode='r'):
-        return self.zip.open(self.name, mode)
+        if self.mapped:
+            try:
+                return MappedFile(self.archive.mmap, self.archive.dataOffset(self.info), self.info.file_size, self.name)
+            except Exception:
+                log.warning("couldn't map %s from %s, reading it normally", self.name, self.zipPath)
+                log.debug("dumping traceback", exc_info=True)
+
+        return self.zip.open(self.info, mode)
 
     def openRealFile(self):
+        # always a real file, even for mapped members: callers may want its fileno or path
+        if extractionCache.enabled:
+            return open(self.realPath, 'rb')
         return self.tempFile()
 
     @property
     def realPath(self):
+        if extractionCache.enabled:
+            try:
+                return extractionCache.get(self)
+            except Exception:
+                log.warning("couldn't extract %s from %s into the cache, falling back to a temporary file", self.name, self.zipPath)
+                log.debug("dumping traceback", exc_info=True)
+
         return super(ZipArchiveFile, self).realPath
 
+    @property
+    def fingerprint(self):
+        info = self.info
+        return self.zipPath, info.filename, info.CRC & 0xffffffff, info.file_size
+
     def __repr__(self):
         return "ZipArchiveFile(%s, %s)" % (repr(self.zipPath), repr(self.name))
 
-class ZipArchive(VirtualDirectory):
+class ZipArchiveDirectory(VirtualDirectory):
+    # A view of a directory inside a ZipArchive. Its contents are only materialized when it's listed,
+    # iterated over or modified; until then, lookups go straight to the archive's flat member table.
+
+    def __init__(self, archive, path):
+        super(ZipArchiveDirectory, self).__init__()
+        self.archive = archive
+        self.path = path
+        self._dict = None
+
+    @property
+    def dict(self):
+        if self._dict is None:
+            self._dict = self.archive.listDir(self.path)
+        return self._dict
+
+    @dict.setter
+    def dict(self, v):
+        self._dict = v
+
+    def locate(self, vpath, createDirs=False, put=None):
+        if put is None and self.archive.pristine:
+            if not isinstance(vpath, unicode):
+                vpath = vpath.decode('utf-8')
+
+            parts = tuple(iterPath(vpath))
+
+            if VPATH_PARENT not in parts:
+                node = self.archive.lookup(joinPath(self.path, *parts))
+
+                if node is not None:
+                    return node
+
+                if not createDirs:
+                    raise NodeNotFoundError("Virtual path %s not found" % vpath)
+
+        return super(ZipArchiveDirectory, self).locate(vpath, createDirs, put)
+
+    def __contains__(self, i):
+        if self._dict is None and i not in VPATH_SPECIAL:
+            return self.archive.lookup(joinPath(self.path, i)) is not None
+        return super(ZipArchiveDirectory, self).__contains__(i)
+
+    def __getitem__(self, i):
+        if self._dict is None and i not in VPATH_SPECIAL:
+            node = self.archive.lookup(joinPath(self.path, i))
+            if node is None:
+                raise KeyError(i)
+            return node
+        return super(ZipArchiveDirectory, self).__getitem__(i)
+
+    def __setitem__(self, i, v):
+        self.archive.pristine = False
+        super(ZipArchiveDirectory, self).__setitem__(i, v)
+
+    def __delitem__(self, i):
+        self.archive.pristine = False
+        super(ZipArchiveDirectory, self).__delitem__(i)
+
+    def __repr__(self):
+        return "ZipArchiveDirectory(%s, %s)" % (repr(self.archive.zipPath), repr(self.path))
+
+class ZipArchive(ZipArchiveDirectory):
     def __init__(self, path):
-        super(ZipArchive, self).__init__()
-        self.isDir = True
+        self.zipPath = os.path.abspath(path)
+        self._zip = None
+        self._mmap = None
+        self._tree = None
+        self.members = {}
+        self.nodes = {"": self}
+
+        # cleared as soon as anything is merged into the archive's tree, which makes the
+        # flat member table no longer authoritative
+        self.pristine = True
 
-        self.name = self.zipPath = os.path.abspath(path)
+        super(ZipArchive, self).__init__(self, "")
+        self.name = self.zipPath
 
         try:
-            self.zip = zipfile.ZipFile(self.zipPath)
+            # the central directory is only read if the index is stale, otherwise it's deferred until a member is opened
+            infos = index.listPack(self.zipPath, lambda: self.zip)
         except Exception:
             log.warning("loading pack %s failed", self.zipPath)
             return
 
-        filesAdded = 0
-        for name in self.zip.namelist():
-            vpath = name.replace("\\", "/")
-            fname = os.path.split(vpath)[-1]
+        for info in infos:
+            vpath = info.filename.replace("\\", VPATH_SEP)
+
+            if vpath.endswith(VPATH_SEP):
+                continue
+
+            if not isinstance(vpath, unicode):
+                vpath = vpath.decode('utf-8', 'replace')
+
+            vpath = normalizePath(vpath)
+
+            if vpath:
+                self.members[vpath] = info
+
+        log.info("added pack %s (%i files)", self.zipPath, len(self.members))
+
+    @property
+    def zip(self):
+        if self._zip is None:
+            self._zip = zipfile.ZipFile(self.zipPath)
+            openArchives[id(self)] = self
+        return self._zip
+
+    @property
+    def mmap(self):
+        if self._mmap is None:
+            with open(self.zipPath, 'rb') as f:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            openArchives[id(self)] = self
+        return self._mmap
+
+    def close(self):
+        # releases the archive and its mapping, they're reopened on demand. Files opened from it must be closed first.
+        if self._zip is not None:
+            self._zip.close()
+            self._zip = None
+
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+        openArchives.pop(id(self), None)
+
+    def dataOffset(self, info):
+        # the local header may carry a different extra field than the central directory, so it has to be read
+        ofs = info.header_offset
+        header = self.mmap[ofs:ofs + 30]
+
+        if len(header) != 30 or header[:4] != b"PK\003\004":
+            raise zipfile.BadZipfile("bad local file header for %s in %s" % (info.filename, self.zipPath))
+
+        fnameLen, extraLen = struct.unpack(b"<HH", header[26:30])
+        return ofs + 30 + fnameLen + extraLen
+
+    @property
+    def tree(self):
+        if self._tree is None:
+            tree = {"": set()}
+
+            for path in self.members:
+                while path:
+                    parent, sep, name = path.rpartition(VPATH_SEP)
+                    known = parent in tree
+                    tree.setdefault(parent, set()).add(name)
+
+                    if known:
+                        break
+
+                    path = parent
+
+            self._tree = tree
+
+        return self._tree
+
+    def lookup(self, path):
+        node = self.nodes.get(path)
 
-            if fname:
-                self.locate(vpath, True, ZipArchiveFile(self, name))
-                filesAdded += 1
+        if node is not None:
+            return node
 
-        log.info("added pack %s (%i files)", self.zipPath, filesAdded)
+        info = self.members.get(path)
+
+        if info is not None:
+            node = ZipArchiveFile(self, info)
+        elif path in self.tree:
+            node = ZipArchiveDirectory(self, path)
+        else:
+            return None
+
+        parent, sep, node.vname = path.rpartition(VPATH_SEP)
+        node.parent = self.lookup(parent)
+        self.nodes[path] = node
+        return node
+
+    def listDir(self, path):
+        return dict((name, self.lookup(joinPath(path, name))) for name in self.tree.get(path, ()))
 
 class BasePack(object):
     def __init__(self, name, ifExists='error'):
@@ -535,6 +1157,53 @@ class BasePack(object):
     def save(self):
         pass
 
+def remainingSize(fobj):
+    # how much is left to read from fobj, if that can be told without reading it
+    try:
+        pos = fobj.tell()
+        fobj.seek(0, os.SEEK_END)
+        end = fobj.tell()
+        fobj.seek(pos)
+    except Exception:
+        return None
+
+    return end - pos
+
+def appendZipMember(zip, zinfo, write, align=1):
+    # Adds a member to a zipfile.ZipFile opened for writing, streaming its data: ZipFile.write only takes whole
+    # files from disk. This is the only place that relies on the internals of ZipFile (as of CPython 2.7).
+    #
+    # write(fp) writes the (compressed) data to fp and returns its CRC, size and compressed size. With align > 1,
+    # the extra field is padded (as zipalign does) so that the data starts on a multiple of align. If anything
+    # fails, the archive is truncated back to where the member would have started.
+
+    fp = zip.fp
+    zinfo.header_offset = fp.tell()
+    zinfo.file_size = zinfo.compress_size = zinfo.CRC = 0
+    zip._writecheck(zinfo)
+
+    if align > 1:
+        base = zinfo.header_offset + 30 + len(zinfo.filename) + 6
+        zinfo.extra = struct.pack(b"<HHH", 0xd935, 2 + (-base % align), align) + b"\0" * (-base % align)
+
+    try:
+        fp.write(zinfo.FileHeader(False))
+        zinfo.CRC, zinfo.file_size, zinfo.compress_size = write(fp)
+
+        # go back and write the header again, now with the real sizes and checksum
+        position = fp.tell()
+        fp.seek(zinfo.header_offset)
+        fp.write(zinfo.FileHeader(False))
+        fp.seek(position)
+    except:
+        fp.seek(zinfo.header_offset)
+        fp.truncate()
+        raise
+
+    zip._didModify = True
+    zip.filelist.append(zinfo)
+    zip.NameToInfo[zinfo.filename] = zinfo
+
 class Pack(BasePack):
     def __init__(self, name, ifExists='error'):
         super(Pack, self).__init__(name, ifExists)
@@ -553,7 +1222,64 @@ class Pack(BasePack):
         name = self.getFilePrefix() + name
         if isinstance(name, unicode):
             name = name.encode('utf-8')
-        self.zip.writestr(name, fobj.read())
+
+        # already compressed media gains nothing from deflate, and stored members can be mapped by readers
+        ext = os.path.splitext(name)[-1][1:].lower()
+        store = ext in config["pack-store-extensions"]
+
+        zinfo = zipfile.ZipInfo(name, time.localtime()[:6])
+        zinfo.external_attr = 0o644 << 16
+        zinfo.compress_type = zipfile.ZIP_STORED if store else zipfile.ZIP_DEFLATED
+        zinfo.flag_bits = 0x00
+
+        # refuse what can't fit before writing anything (no zip64 here); deflate may grow the data a little
+        size = remainingSize(fobj)
+        if size is not None and not store:
+            size += (size >> 12) + (size >> 14) + (size >> 25) + 13
+
+        if size is not None and size > zipfile.ZIP64_LIMIT:
+            raise zipfile.LargeZipFile("%s is too large to be added to pack %s" % (name, self.path))
+
+        def write(fp):
+            if store:
+                cmpr = None
+            else:
+                cmpr = zlib.compressobj(config["pack-compression-level"], zlib.DEFLATED, -15)
+
+            crc = 0
+            size = 0
+            csize = 0
+
+            while True:
+                buf = fobj.read(64 * 1024)
+
+                if not buf:
+                    break
+
+                size += len(buf)
+                crc = zlib.crc32(buf, crc) & 0xffffffff
+
+                if cmpr is not None:
+                    buf = cmpr.compress(buf)
+
+                csize += len(buf)
+                fp.write(buf)
+
+                # sources of unknown size are only caught here, appendZipMember drops what's been written
+                if max(size, csize) > zipfile.ZIP64_LIMIT:
+                    raise zipfile.LargeZipFile("%s is too large to be added to pack %s" % (name, self.path))
+
+            if cmpr is not None:
+                buf = cmpr.flush()
+                csize += len(buf)
+                fp.write(buf)
+
+                if csize > zipfile.ZIP64_LIMIT:
+                    raise zipfile.LargeZipFile("%s is too large to be added to pack %s" % (name, self.path))
+
+            return crc, size, csize
+
+        appendZipMember(self.zip, zinfo, write, align=config["pack-store-alignment"] if store else 1)
 
     def save(self):
         self.zip.close()
@@ -584,6 +1310,9 @@ class VirtualPack(BasePack):
 
 @atexit.register
 def cleanup():
+    for archive in openArchives.values():
+        archive.close()
+
     for tmp in tempfiles:
         log.info("removing temporary file %s", tmp.name)
         try:
@@ -596,6 +1325,10 @@ def cleanup():
 
     del tempfiles[:]
 
+@atexit.register
+def saveIndex():
+    index.save()
+
 root = RootDirectory()
 
 def locate(path, **kwargs):
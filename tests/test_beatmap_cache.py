@@ -0,0 +1,52 @@
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+from __future__ import unicode_literals
+
+import os, json, shutil, tempfile, unittest
+
+import muz.vfs as vfs
+from muz.beatmap.cache import BeatmapCache
+from muz.beatmap.formats import tianyi9
+
+LIVE = {
+    "audiofile" : "song.mp3",
+    "lane"      : [[
+        {"starttime": 1050, "endtime": 1050, "lane": 0, "longnote": False},
+        {"starttime": 2050, "endtime": 2050, "lane": 0, "longnote": False},
+    ]],
+}
+
+class BeatmapCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.offset = tianyi9.config["offset"]
+
+        path = os.path.join(self.dir, "live.json")
+        with open(path, 'w') as f:
+            json.dump(LIVE, f)
+
+        self.node = vfs.RealFile(path)
+        self.cache = BeatmapCache()
+        self.cache.open(os.path.join(self.dir, "cache"))
+
+    def tearDown(self):
+        tianyi9.config["offset"] = self.offset
+        shutil.rmtree(self.dir)
+
+    def hitTimes(self):
+        return [note.hitTime for note in self.cache.read(tianyi9, self.node, "live.json")]
+
+    def testImporterConfigChange(self):
+        tianyi9.config["offset"] = 0
+        self.assertEqual(self.hitTimes(), [1050, 2050])
+        self.assertEqual(self.hitTimes(), [1050, 2050])
+        self.assertEqual(self.cache.hits, 1)
+
+        # a different offset must not be served the notes parsed with the old one
+        tianyi9.config["offset"] = 450
+        self.assertEqual(self.hitTimes(), [1500, 2500])
+        self.assertEqual(self.cache.hits, 1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,71 @@
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+from __future__ import unicode_literals
+
+import os, shutil, tempfile, unittest, zipfile
+
+import muz.main
+import muz.vfs as vfs
+import muz.beatmap
+from muz.beatmap import Beatmap, Note, formats
+
+class ExportTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.userdir = muz.main.userdir
+        muz.main.userdir = self.dir
+
+    def tearDown(self):
+        muz.main.userdir = self.userdir
+        shutil.rmtree(self.dir)
+
+    def song(self, subdir, data):
+        path = os.path.join(self.dir, subdir)
+        os.makedirs(path)
+
+        with open(os.path.join(path, "audio.ogg"), 'wb') as f:
+            f.write(data)
+
+        return path
+
+    def beatmap(self, path, title, variant):
+        source = os.path.join(path, "%s.osu" % variant)
+        open(source, 'w').close()
+
+        bmap = Beatmap(None, 9, "audio.ogg", vfsNode=vfs.RealFile(source))
+        bmap.meta["Music.Name"] = title
+        bmap.meta["Beatmap.Variant"] = variant
+        bmap.applyMeta()
+
+        for i in xrange(10):
+            bmap.append(Note(i % 9, 1000 + i * 100, 0))
+
+        return bmap
+
+    def export(self, format, *bmaps):
+        muz.beatmap.export(*bmaps, format=format, packType=vfs.Pack, name="exported")
+
+        with zipfile.ZipFile(os.path.join(self.dir, "exported.pk3")) as z:
+            return dict((i.filename, z.read(i.filename)) for i in z.infolist())
+
+    def testSharedMusicStoredOnce(self):
+        path = self.song("song", b"a" * 1000)
+
+        for format in formats.siftrain, formats.muz:
+            files = self.export(format, self.beatmap(path, "Song", "Easy"), self.beatmap(path, "Song", "Hard"))
+            music = [name for name in files if name.endswith(".ogg")]
+
+            self.assertEqual(len(files), 3, format.__name__)
+            self.assertEqual(len(music), 1, format.__name__)
+
+    def testClashingMusicRenamed(self):
+        a = self.beatmap(self.song("a", b"a" * 1000), "A", "Easy")
+        b = self.beatmap(self.song("b", b"b" * 1000), "B", "Easy")
+
+        files = self.export(formats.siftrain, a, b)
+        music = sorted(data for name, data in files.items() if name.endswith(".ogg"))
+        self.assertEqual(music, [b"a" * 1000, b"b" * 1000])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,63 @@
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+from __future__ import unicode_literals
+
+import random, unittest
+
+from muz.beatmap import Beatmap, Note
+
+def distance(note, time):
+    return min(abs(note.hitTime - time), abs(note.hitTime + note.holdTime - time))
+
+class NearestTest(unittest.TestCase):
+    def setUp(self):
+        self.rnd = random.Random(1)
+        self.bmap = Beatmap("test", 5, "music.ogg")
+
+        for i in xrange(500):
+            self.bmap.append(self.randomNote())
+
+    def randomNote(self):
+        rnd = self.rnd
+        hold = rnd.choice((0, 0, 0, rnd.randint(1, 3000)))
+        return Note(rnd.randrange(5), rnd.randint(0, 60000), hold, isHint=rnd.random() < 0.05)
+
+    def check(self, skip):
+        rnd = self.rnd
+
+        for i in xrange(300):
+            band = rnd.randrange(6)
+            time = rnd.randint(-1000, 61000)
+            maxdiff = rnd.choice((50, 200, 1000))
+
+            candidates = [n for n in self.bmap if n.band == band and not n.isHint and n not in skip]
+            best = min([distance(n, time) for n in candidates] or [maxdiff])
+
+            note = self.bmap.nearest(band, time, maxdiff, skip=skip)
+
+            if best >= maxdiff:
+                self.assertIsNone(note)
+            else:
+                self.assertIn(note, candidates)
+                self.assertEqual(distance(note, time), best)
+
+    def testLinearScan(self):
+        self.check(())
+
+    def testSkip(self):
+        notes = list(self.bmap)
+        self.check(set(self.rnd.sample(notes, 250)))
+        self.check(set(notes))
+
+    def testAfterChanges(self):
+        for i in xrange(10):
+            for j in xrange(20):
+                del self.bmap[self.rnd.randrange(len(self.bmap))]
+
+            self.bmap.insert(self.rnd.randrange(len(self.bmap)), self.randomNote())
+            self.bmap.append(self.randomNote())
+            self.check(set(self.rnd.sample(list(self.bmap), 50)))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+from __future__ import unicode_literals
+
+import io, struct, unittest
+
+from muz.beatmap import Beatmap, Note
+from muz.beatmap.formats import muzb
+
+FIELDS = ("magic", "version", "metacount", "hsize", "numnotes", "numbands", "sidesize", "rate")
+
+def beatmap():
+    bmap = Beatmap(None, 7, "sound/ミュージック.ogg")
+    bmap.meta["Music.Name"] = "Song"
+    bmap.meta["Beatmap.Variant"] = "Hard"
+    bmap.noterate = 1.5
+    bmap.applyMeta()
+
+    for i in xrange(50):
+        bmap.append(Note(i % 7, i * 250, 500 if i % 5 == 0 else 0))
+
+    bmap.append(Note(0, 15000, 0, varBands=[1, 3, 5]))
+    bmap.append(Note(0, 15500, 0, ref=50, refOfs=2, refVarOfs=[0, 1]))
+    bmap.append(Note(3, 16000, -1, isHint=True))
+    return bmap
+
+class MuzbTest(unittest.TestCase):
+    def setUp(self):
+        self.bmap = beatmap()
+        f = io.BytesIO()
+        muzb.write(self.bmap, f)
+        self.data = f.getvalue()
+
+    def read(self, data):
+        return muzb.read(io.BytesIO(data), "test.muzb")
+
+    def patchHeader(self, **fields):
+        vals = dict(zip(FIELDS, muzb.HEADER.unpack_from(self.data)))
+        vals.update(fields)
+        return muzb.HEADER.pack(*[vals[f] for f in FIELDS]) + self.data[muzb.HEADER.size:]
+
+    def withSide(self, *side):
+        # the same notes with a different side table
+        data = self.patchHeader(sidesize=len(side))
+        sidesize = muzb.HEADER.unpack_from(self.data)[FIELDS.index("sidesize")]
+        return data[:len(data) - sidesize * 4] + struct.pack(b"<%ii" % len(side), *side)
+
+    def testRoundTrip(self):
+        bmap = self.read(self.data)
+
+        self.assertEqual(bmap.name, self.bmap.name)
+        self.assertEqual(bmap.music, self.bmap.music)
+        self.assertEqual(bmap.numbands, 7)
+        self.assertEqual(bmap.noterate, 1.5)
+        self.assertEqual(dict(bmap.meta.items()), dict(self.bmap.meta.items()))
+        self.assertEqual([n.values for n in bmap], [n.values for n in self.bmap])
+
+    def testProbe(self):
+        bmap = muzb.probe(io.BytesIO(self.data[:muzb.HEADER.unpack_from(self.data)[3]]), "test.muzb")
+        self.assertEqual(bmap.name, self.bmap.name)
+        self.assertEqual(len(bmap), 0)
+
+    def testCorrupt(self):
+        for data in (
+            b"",
+            self.data[:muzb.HEADER.size],
+            b"MUZX" + self.data[4:],
+            self.patchHeader(version=muzb.VERSION + 1),
+            self.patchHeader(hsize=0),
+            self.patchHeader(hsize=muzb.HEADER.size + 2),
+            self.patchHeader(hsize=len(self.data) * 2),
+            self.data[:-4],
+            # a note index past the end, a negative one, more values than are left, a truncated entry
+            self.withSide(53, 0, 1, 0),
+            self.withSide(-1, 0, 1, 0),
+            self.withSide(0, 0, 2, 0),
+            self.withSide(0, 0, 0, 0),
+        ):
+            self.assertRaises(muzb.ParseError, self.read, data)
+
+if __name__ == "__main__":
+    unittest.main()
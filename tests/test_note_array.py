@@ -0,0 +1,152 @@
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+from __future__ import unicode_literals
+
+import random, unittest
+
+from muz.beatmap import Beatmap, Note, NoteArray
+
+def notes(count, start=0):
+    return [Note(i % 4, (start + i) * 100, 0) for i in xrange(count)]
+
+class NoteArrayTest(unittest.TestCase):
+    def assertSameNotes(self, array, model):
+        self.assertEqual(len(array), len(model))
+        self.assertEqual([n.hitTime for n in array], [n.hitTime for n in model])
+
+        # views are kept, so the notes that went in are the notes that come out
+        for a, b in zip(array, model):
+            self.assertIs(a, b)
+
+        for pos, note in enumerate(model):
+            self.assertEqual(array.index(note), pos)
+            self.assertEqual(note.num, pos)
+
+    def testInsertDelete(self):
+        rnd = random.Random(1)
+        array = NoteArray()
+        model = []
+
+        # the hit time of every note is the step it was made in
+        for i in xrange(2000):
+            op = rnd.random()
+
+            if op < 0.3 or not model:
+                note = Note(0, i, 0)
+                array.append(note)
+                model.append(note)
+            elif op < 0.5:
+                note = Note(0, i, 0)
+                pos = rnd.randint(-len(model), len(model))
+                array.insert(pos, note)
+                model.insert(pos, note)
+            elif op < 0.8:
+                pos = rnd.randrange(len(model))
+                removed = model.pop(pos)
+                del array[pos]
+
+                # removed notes keep their values
+                self.assertNotIn(removed, array)
+                self.assertLess(removed.hitTime, i)
+                self.assertEqual(removed.band, 0)
+            elif op < 0.9:
+                start = rnd.randrange(len(model))
+                stop = start + rnd.randint(0, 5)
+                del model[start:stop]
+                del array[start:stop]
+            else:
+                note = Note(0, i, 0)
+                pos = rnd.randrange(len(model))
+                model[pos] = note
+                array[pos] = note
+
+            if i % 100 == 0:
+                self.assertSameNotes(array, model)
+
+        self.assertSameNotes(array, model)
+
+    def testCompact(self):
+        model = notes(100)
+        array = NoteArray(model)
+
+        removed = model[10:60:2]
+        del model[10:60:2]
+        del array[10:60:2]
+
+        compactions = array.compactions
+        array.compact()
+        self.assertEqual(array.compactions, compactions + 1)
+        self.assertEqual(list(array.rows), range(len(model)))
+        self.assertSameNotes(array, model)
+
+        for note in removed:
+            self.assertNotIn(note, array)
+            self.assertEqual(note.hitTime // 100 % 4, note.band)
+
+        # removed notes that were detached can go into another array
+        other = NoteArray(removed)
+        self.assertEqual([n.hitTime for n in other], [n.hitTime for n in removed])
+
+    def testCopyOnWrite(self):
+        array = NoteArray(notes(10))
+        copy = array.copy()
+
+        copy[0].band = 3
+        copy[1].varBands = [1, 2]
+        del copy[5]
+        copy.append(Note(1, 5000, 0))
+        copy.insert(0, Note(2, 0, 0))
+
+        self.assertEqual([n.band for n in array], [i % 4 for i in xrange(10)])
+        self.assertEqual([n.hitTime for n in array], [i * 100 for i in xrange(10)])
+        self.assertIsNone(array[1].varBands)
+
+        self.assertEqual(copy[1].band, 3)
+        self.assertEqual(copy[2].varBands, [1, 2])
+        self.assertEqual(len(copy), 11)
+
+        # and the other way around
+        array[0].hitTime = 50
+        array.append(Note(0, 9000, 0))
+        self.assertEqual(copy[1].hitTime, 0)
+        self.assertEqual(len(copy), 11)
+
+    def testCloneIsolation(self):
+        bmap = Beatmap("test", 4, "music.ogg", source=notes(20))
+        bmap.buildIndex()
+
+        clone = bmap.clone()
+        clone[0].band = 1
+        clone.invalidateIndex()
+        del clone[1:10]
+        clone.append(Note(0, 100000, 0))
+        clone.notelist.compact()
+
+        self.assertEqual(len(bmap), 20)
+        self.assertEqual([n.band for n in bmap], [i % 4 for i in xrange(20)])
+        self.assertEqual(bmap.nearest(0, 0, 50), bmap[0])
+        self.assertEqual(bmap.nearest(1, 900, 50), bmap[9])
+
+        self.assertEqual(len(clone), 12)
+        self.assertEqual(clone.nearest(1, 0, 50), clone[0])
+        self.assertIsNone(clone.nearest(1, 900, 50))
+
+    def testIterationSeesChanges(self):
+        array = NoteArray(notes(6))
+        array.copy()
+        seen = []
+
+        for note in array:
+            seen.append(note.hitTime)
+
+            # both replace the row order that the iteration started with
+            if note.hitTime == 100:
+                del array[3]
+            elif note.hitTime == 400:
+                array.append(Note(0, 900, 0))
+
+        self.assertEqual(seen, [0, 100, 200, 400, 500, 900])
+
+if __name__ == "__main__":
+    unittest.main()